@@ -0,0 +1,108 @@
+## Long-lived, thread-safe store for the aux DB (locations, systems, jumps, items)
+## One connection for the whole process, new rows are buffered and written out in batched transactions
+
+import atexit
+import threading
+
+import sqlitetools
+
+FLUSH_EVERY = 500 # buffered rows before an automatic flush
+
+# table: (key columns, value columns)
+TABLES = {
+	'locations': (('locationID',), ('systemID', 'locationName')),
+	'systems': (('systemID',), ('systemName', 'security')),
+	'jumps': (('system1', 'system2', 'highsecOnly'), ('jumps',)),
+	'items': (('itemID',), ('itemName', 'volume')),
+	}
+
+class AuxStore:
+
+	def __init__(self, db, flush_every=FLUSH_EVERY):
+		self.db = db
+		self.flush_every = flush_every
+
+		self._lock = threading.RLock()
+		self._conn = sqlitetools.connect(db, check_same_thread=False)
+
+		# statements are built once here and reused, sqlite3 keeps them prepared in its statement cache
+		self._select, self._selectall, self._insert = {}, {}, {}
+		for table, (keycols, valcols) in TABLES.items():
+			self._select[table] = '''SELECT {} FROM {} WHERE {}'''.format(','.join(valcols), table, ' AND '.join('{}=?'.format(ii) for ii in keycols))
+			self._selectall[table] = '''SELECT {} FROM {}'''.format(','.join(keycols + valcols), table)
+			self._insert[table] = '''INSERT OR REPLACE INTO {} VALUES {}'''.format(table, '(' + ','.join('?'*len(keycols + valcols)) + ')')
+
+		self._pending = {table: {} for table in TABLES}
+		self._npending = 0
+
+		atexit.register(self.close)
+
+	@staticmethod
+	def _key(key):
+		return (key if isinstance(key, tuple) else (key,))
+
+	def get(self, table, key):
+		# returns tuple of value columns, or None if we don't have it
+		key = self._key(key)
+
+		with self._lock:
+			if key in self._pending[table]: return self._pending[table][key]
+
+			row = self._conn.execute(self._select[table], key).fetchone()
+
+		return row
+
+	def getmany(self, table, keys):
+		# returns {key: values} for every key we have, in one read
+		nkeycols = len(TABLES[table][0])
+		keys = set(keys)
+
+		with self._lock:
+			found = {}
+			for row in self._conn.execute(self._selectall[table]):
+				key = (row[0] if nkeycols == 1 else row[:nkeycols])
+				if key in keys: found[key] = row[nkeycols:]
+
+			for key, values in self._pending[table].items():
+				key = (key[0] if nkeycols == 1 else key)
+				if key in keys: found[key] = values
+
+		return found
+
+	def put(self, table, key, values):
+		# buffer a row, it's written out on the next flush
+		with self._lock:
+			self._pending[table][self._key(key)] = tuple(values)
+			self._npending += 1
+
+			if self._npending >= self.flush_every: self.flush()
+
+	def putmany(self, table, rows):
+		# rows: iterable of (key, values)
+		with self._lock:
+			for key, values in rows:
+				self._pending[table][self._key(key)] = tuple(values)
+				self._npending += 1
+
+			if self._npending >= self.flush_every: self.flush()
+
+	def flush(self):
+		with self._lock:
+			if not self._npending: return
+
+			with self._conn:
+				for table, rows in self._pending.items():
+					if rows: self._conn.executemany(self._insert[table], (key + values for key, values in rows.items()))
+
+			self._pending = {table: {} for table in TABLES}
+			self._npending = 0
+
+	def close(self):
+		with self._lock:
+			if self._conn is None: return
+
+			self.flush()
+			self._conn.close()
+			self._conn = None
+
+		atexit.unregister(self.close)
@@ -0,0 +1,170 @@
+## Columnar (NumPy) view of a set of orders, for finding trade candidates without looping over orders in Python
+
+import numpy as np
+
+import orderbook
+import jumpgraph
+
+MAX_PAIRS_PER_CHUNK = 1000000 # (sell system, buy system) pairs compared at once, bounds temporary memory
+
+DTYPES = {'q': np.int64, 'b': np.int8, 'd': np.float64} # orderbook column typecodes
+
+class OrderColumns:
+
+	def __init__(self, itemID, systemID, isbuy, price, qty, locationID=None):
+		self.itemID = itemID
+		self.locationID = locationID
+		self.systemID = systemID
+		self.isbuy = isbuy
+		self.price = price
+		self.qty = qty
+
+	def __len__(self):
+		return len(self.itemID)
+
+	@classmethod
+	def frombook(cls, book):
+		# zero-copy: the arrays share memory with the book (which can't grow while they're alive)
+		return cls(itemID=np.frombuffer(book.itemID, dtype=np.int64),
+					systemID=np.where(np.frombuffer(book.systemID, dtype=np.int64) == 0, -1, np.frombuffer(book.systemID, dtype=np.int64)),
+					isbuy=np.frombuffer(book.isbuy, dtype=np.int8).view(np.bool_),
+					price=np.frombuffer(book.price, dtype=np.float64),
+					qty=np.frombuffer(book.orderQty, dtype=np.int64),
+					locationID=np.frombuffer(book.locationID, dtype=np.int64))
+
+	@classmethod
+	def fromorders(cls, orders):
+		if isinstance(orders, orderbook.OrderBook): return cls.frombook(orders)
+
+		# unknown systems get -1
+		n = len(orders)
+		return cls(itemID=np.fromiter((ii.itemID for ii in orders), dtype=np.int64, count=n),
+					systemID=np.fromiter(((-1 if ii.systemID is None else ii.systemID) for ii in orders), dtype=np.int64, count=n),
+					isbuy=np.fromiter((ii.orderType == 'buy' for ii in orders), dtype=np.bool_, count=n),
+					price=np.fromiter((ii.price for ii in orders), dtype=np.float64, count=n),
+					qty=np.fromiter((ii.orderQty for ii in orders), dtype=np.int64, count=n),
+					locationID=np.fromiter((ii.locationID for ii in orders), dtype=np.int64, count=n))
+
+def takebook(book, idx):
+	# new OrderBook with copies of just the orders at positions idx
+	new = orderbook.OrderBook()
+	for name, typecode in orderbook.COLUMNS: getattr(new, name).frombytes(np.frombuffer(getattr(book, name), dtype=DTYPES[typecode])[idx].tobytes())
+	return new
+
+def groupbook(cols):
+	# group orders by (item, buy/sell, system), each group sorted into a book: sells low -> high, buys high -> low
+	# returns (order indices sorted by group, then price), group start offsets into that, and per-group
+	# item, isbuy, system, min price, max price, first original position, first original position of the group's item
+	bookprice = np.where(cols.isbuy, -cols.price, cols.price)
+	order = np.lexsort((bookprice, cols.systemID, cols.isbuy, cols.itemID)) # lexsort is stable, so equal prices keep original order
+	item_s, isbuy_s, sys_s, price_s = cols.itemID[order], cols.isbuy[order], cols.systemID[order], cols.price[order]
+
+	newgroup = np.empty(len(order), dtype=np.bool_)
+	newgroup[:1] = True
+	newgroup[1:] = (item_s[1:] != item_s[:-1]) | (isbuy_s[1:] != isbuy_s[:-1]) | (sys_s[1:] != sys_s[:-1])
+	starts = np.flatnonzero(newgroup)
+
+	newitem = np.empty(len(order), dtype=np.bool_)
+	newitem[:1] = True
+	newitem[1:] = (item_s[1:] != item_s[:-1])
+	itemstarts = np.flatnonzero(newitem)
+	itemfirst = np.minimum.reduceat(order, itemstarts)
+
+	groups = {
+		'item': item_s[starts],
+		'isbuy': isbuy_s[starts],
+		'system': sys_s[starts],
+		'minprice': np.minimum.reduceat(price_s, starts),
+		'maxprice': np.maximum.reduceat(price_s, starts),
+		'first': np.minimum.reduceat(order, starts),
+		'itemfirst': itemfirst[np.searchsorted(itemstarts, starts, side='right') - 1],
+		}
+
+	return order, starts, groups
+
+def _crossjoin(sells, buys, groups):
+	# all (sell group, buy group) pairs for the same item where min sell < max buy
+	buyitems = groups['item'][buys]
+	lo = np.searchsorted(buyitems, groups['item'][sells], side='left')
+	counts = np.searchsorted(buyitems, groups['item'][sells], side='right') - lo
+
+	paircum = np.cumsum(counts)
+	pairs_sell, pairs_buy = [], []
+
+	# do it in chunks of sell groups so we never hold more than ~MAX_PAIRS_PER_CHUNK pairs at once
+	chunkstart = 0
+	while chunkstart < len(sells):
+		base = (paircum[chunkstart-1] if chunkstart else 0)
+		chunkend = max(int(np.searchsorted(paircum, base + MAX_PAIRS_PER_CHUNK, side='right')), chunkstart+1)
+
+		cc = counts[chunkstart:chunkend]
+		ps = np.repeat(sells[chunkstart:chunkend], cc)
+		offsets = np.arange(cc.sum()) - np.repeat(np.cumsum(cc) - cc, cc)
+		pb = buys[np.repeat(lo[chunkstart:chunkend], cc) + offsets]
+
+		profitable = groups['minprice'][ps] < groups['maxprice'][pb]
+		pairs_sell.append(ps[profitable])
+		pairs_buy.append(pb[profitable])
+
+		chunkstart = chunkend
+
+	if not pairs_sell: return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+	return np.concatenate(pairs_sell), np.concatenate(pairs_buy)
+
+def pairjumps(graph, systems1, systems2, highseconly):
+	# vectorised JumpGraph.jumps: jump counts for arrays of system pairs, jumpgraph.UNREACHABLE where there's no route
+	systems = np.asarray(graph.systems, dtype=np.int64) # sorted
+	n = len(systems)
+	if not n: return np.where(systems1 == systems2, 0, jumpgraph.UNREACHABLE)
+
+	ii, jj = np.searchsorted(systems, systems1), np.searchsorted(systems, systems2)
+	known = (systems[np.minimum(ii, n-1)] == systems1) & (systems[np.minimum(jj, n-1)] == systems2)
+	lo, hi = np.minimum(ii, jj), np.maximum(ii, jj)
+	offdiag = known & (lo != hi)
+
+	def lookup(matrix):
+		pos = np.where(offdiag, lo*n - lo*(lo+1)//2 + (hi - lo - 1), 0)
+		return np.where(offdiag, np.frombuffer(matrix, dtype=np.uint8)[pos], jumpgraph.UNREACHABLE).astype(np.int64)
+
+	jumps = lookup(graph.matrices[False])
+	if highseconly:
+		# no highsec route, take the shortest one instead (same as getjumps)
+		safe = lookup(graph.matrices[True])
+		jumps = np.where(safe == jumpgraph.UNREACHABLE, jumps, safe)
+
+	return np.where(systems1 == systems2, 0, jumps)
+
+def findcandidates(cols, pairfilter=None):
+	# profitable (item, sell system, buy system) combinations
+	# pairfilter(sell systems, buy systems): optional, returns a mask of pairs worth keeping
+	# returns list of (itemID, sell group, buy group), ordered by first appearance of item, then sell system, then buy system,
+	# and {group: order indices} for every group used, sorted by price into books ready for fillorders
+	if not len(cols): return [], {}
+
+	order, starts, groups = groupbook(cols)
+	ends = np.append(starts[1:], len(order))
+
+	# a group can only make money if it beats the best price on the other side for its item
+	isbuy, item = groups['isbuy'], groups['item']
+	itembounds = np.flatnonzero(np.append(True, item[1:] != item[:-1]))
+	pricefloor = np.where(isbuy, np.inf, groups['minprice'])
+	priceceil = np.where(isbuy, groups['maxprice'], -np.inf)
+	item_minsell = np.minimum.reduceat(pricefloor, itembounds)[np.searchsorted(itembounds, np.arange(len(item)), side='right') - 1]
+	item_maxbuy = np.maximum.reduceat(priceceil, itembounds)[np.searchsorted(itembounds, np.arange(len(item)), side='right') - 1]
+
+	sells = np.flatnonzero(~isbuy & (groups['minprice'] < item_maxbuy))
+	buys = np.flatnonzero(isbuy & (groups['maxprice'] > item_minsell))
+
+	pairs_sell, pairs_buy = _crossjoin(sells, buys, groups)
+
+	if pairfilter is not None:
+		keep = pairfilter(groups['system'][pairs_sell], groups['system'][pairs_buy])
+		pairs_sell, pairs_buy = pairs_sell[keep], pairs_buy[keep]
+
+	ranking = np.lexsort((groups['first'][pairs_buy], groups['first'][pairs_sell], groups['itemfirst'][pairs_sell]))
+	pairs_sell, pairs_buy = pairs_sell[ranking], pairs_buy[ranking]
+
+	books = {gg: order[starts[gg]:ends[gg]].tolist() for gg in np.union1d(pairs_sell, pairs_buy).tolist()}
+
+	return [(int(item[ss]), ss, bb) for ss, bb in zip(pairs_sell.tolist(), pairs_buy.tolist())], books
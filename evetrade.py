@@ -4,40 +4,162 @@ import os
 import sys
 import time
 import requests
+import numpy as np
 import logging
+import threading
+import heapq
 from operator import itemgetter, attrgetter
 
 from functools import lru_cache
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import sqlitetools
 import dotlanroutescraper
+import pipeline
+import auxstore
+import jumpgraph
+import columnar
+import orderbook
+import httpcache
+import packer
+import orderfilter
+import snapshotfile
 
 DBFILE_ORDERS = 'orders.sqlite'
 DBFILE_AUX = 'auxdata.sqlite'
-
-contraband_types = ('17796', '17796', '17796', '17796', '17796', '17796', '17796', '17796', '12478', '12478', '12478', '11855', '11855', '11855', '11855', '9844', '9844', '9844', '9844', '9844', '9844', '3729', '3729', '3729', '3729', '3729', '3729', '3729', '3729', '3729', '3729', '3729', '3727', '3727', '3727', '3727', '3727', '3721', '3721', '3721', '3721', '3721', '3721', '3721', '3721', '3721', '3721', '3721', '3713', '3713')
+HTTPCACHE_FILE = 'httpcache.sqlite'
+HTTPCACHE_MAXBYTES = httpcache.MAX_BYTES
+SNAPSHOTFILE = 'orders.snap' # memory-mapped copy of the order DB's latest snapshot, see loadorders
+
+# static data export files for the stargate graph, see initjumpgraph
+SDEFILE_JUMPS = 'mapSolarSystemJumps.csv'
+SDEFILE_SYSTEMS = 'mapSolarSystems.csv'
+
+MAX_WORKERS = 8 # max. concurrent requests when pulling order data
+INSERT_BATCH_SIZE = 50000 # rows per transaction when streaming orders into the DB
+READ_CHUNK_SIZE = 50000 # rows per fetch when reading the order DB
+
+# schema migrations, see sqlitetools.migrate: step N takes a DB to version N
+# step 1 is the schema from before versioning, so existing DBs are upgraded from wherever they are
+ORDERDB_MIGRATIONS = (
+	('''CREATE TABLE IF NOT EXISTS orders (orderID INT PRIMARY KEY, itemID INT, locationID INT, orderType TEXT, price REAL, orderQty INT)''',),
+	lambda conn: sqlitetools.addcolumns(conn, 'orders', ('snapshot REAL', 'systemID INT')),
+	# covers the per-(item, buy/sell, system) price lookups in findcandidatesSQL
+	('''CREATE INDEX IF NOT EXISTS orders_book ON orders (itemID,orderType,systemID,price)''',),
+	)
+
+AUXDB_MIGRATIONS = (
+	('''CREATE TABLE IF NOT EXISTS locations (locationID INT PRIMARY KEY, systemID INT, locationName TEXT)''',
+		'''CREATE TABLE IF NOT EXISTS systems (systemID INT PRIMARY KEY, systemName TEXT, security REAL)''',
+		'''CREATE TABLE IF NOT EXISTS jumps (system1 INT, system2 INT, highsecOnly BOOL, jumps INT)''',
+		'''CREATE TABLE IF NOT EXISTS items (itemID INT PRIMARY KEY, itemName TEXT, volume REAL)'''),
+	# key on jumps so getjumps lookups stop scanning the table, the last duplicate written wins
+	('''CREATE TABLE jumps_keyed (system1 INT, system2 INT, highsecOnly BOOL, jumps INT, PRIMARY KEY (system1, system2, highsecOnly)) WITHOUT ROWID''',
+		'''INSERT OR REPLACE INTO jumps_keyed SELECT system1,system2,highsecOnly,jumps FROM jumps ORDER BY rowid''',
+		'''DROP TABLE jumps''',
+		'''ALTER TABLE jumps_keyed RENAME TO jumps'''),
+	)
+
+# raw API field names for (orderID, itemID, locationID, is buy order, price, orderQty)
+ORDERFIELDS = {
+	'esi': ('order_id', 'type_id', 'location_id', 'is_buy_order', 'price', 'volume_remain'),
+	'crest': ('id', 'type', 'stationID', 'buy', 'price', 'volume'),
+	}
+
+_auxstore = None # see getauxstore
+_auxstore_lock = threading.RLock()
+
+_httpcache = None # see gethttpcache
+_httpcache_lock = threading.Lock()
+
+contraband_types = frozenset((17796, 12478, 11855, 9844, 3729, 3727, 3721, 3713))
 	
+def connectorderDB(**kwargs):
+	# connection to the order DB with tuned pragmas, schema brought up to date first
+	# kwargs go to sqlite3.connect
+	conn = sqlitetools.connect(DBFILE_ORDERS, **kwargs)
+	sqlitetools.migrate(conn, ORDERDB_MIGRATIONS)
+	return conn
+
 def initorderDB():
-	if os.path.isfile(DBFILE_ORDERS): os.remove(DBFILE_ORDERS)
-	sqlitetools.createtable(DBFILE_ORDERS, 'orders', ('orderID INT PRIMARY KEY', 'itemID INT', 'locationID INT', 'orderType TEXT', 'price REAL', 'orderQty INT'))
+	# empty the order DB, schema is upgraded in place
+	with connectorderDB() as conn:
+		conn.execute('''DELETE FROM orders''')
+	conn.close()
+	snapshotfile.remove(SNAPSHOTFILE)
 	logger.debug('Initialised order DB')
 
-def initauxDB():
-	if os.path.isfile(DBFILE_AUX): os.remove(DBFILE_AUX)
-	sqlitetools.createtable(DBFILE_AUX, 'locations', ('locationID INT PRIMARY KEY', 'systemID INT', 'locationName TEXT'))
-	sqlitetools.createtable(DBFILE_AUX, 'systems', ('systemID INT PRIMARY KEY', 'systemName TEXT', 'security REAL'))
-	sqlitetools.createtable(DBFILE_AUX, 'jumps', ('system1 INT', 'system2 INT', 'highsecOnly BOOL', 'jumps INT'))
-	sqlitetools.createtable(DBFILE_AUX, 'items', ('itemID INT PRIMARY KEY', 'itemName TEXT', 'volume REAL'))
-	logger.debug('Initialised aux DB')
-
-def reqget(url, params=None, timeout=10, max_attempts=5, wait_between_attempts=2, session=None):
+def opensnapshot(conn):
+	# staging table for a new snapshot of orders, lives in temp storage on this connection only
+	conn.execute('''DROP TABLE IF EXISTS temp.newsnapshot''')
+	conn.execute('''CREATE TEMP TABLE newsnapshot (orderID INT PRIMARY KEY, itemID INT, locationID INT, orderType TEXT, price REAL, orderQty INT, systemID INT)''')
+
+def applysnapshot(conn, timestamp=None):
+	# bring the orders table in line with the staged snapshot in one transaction:
+	# vanished orders are deleted, new ones inserted, and only orders whose price, quantity or location moved are rewritten
+	# (a system the staged snapshot knows replaces an unknown or stale one, an unknown one never wipes a known one)
+	# returns (added, changed, removed)
+	if timestamp is None: timestamp = time.time()
+
+	# first load into an empty table: one big insert, cheaper to build the index once at the end,
+	# and relaxed pragmas are fine as a crash there has nothing to lose
+	# updates in place keep the normal journal and sync, so a crash mid-save can't leave a broken orders table
+	fresh = (conn.execute('''SELECT 1 FROM orders LIMIT 1''').fetchone() is None)
+	relax = (sqlitetools.relaxed(conn) if fresh else nullcontext())
+	defer = (sqlitetools.deferredindexes(conn, 'orders') if fresh else nullcontext())
+
+	with relax, defer, conn:
+		removed = conn.execute('''DELETE FROM orders WHERE orderID NOT IN (SELECT orderID FROM temp.newsnapshot)''').rowcount
+		added = conn.execute('''SELECT COUNT(*) FROM temp.newsnapshot WHERE orderID NOT IN (SELECT orderID FROM orders)''').fetchone()[0]
+		upserted = conn.execute('''INSERT INTO orders (orderID,itemID,locationID,orderType,price,orderQty,snapshot,systemID)
+									SELECT orderID,itemID,locationID,orderType,price,orderQty,?,systemID FROM temp.newsnapshot WHERE true
+									ON CONFLICT(orderID) DO UPDATE SET price=excluded.price, orderQty=excluded.orderQty, snapshot=excluded.snapshot,
+										locationID=excluded.locationID, systemID=COALESCE(excluded.systemID, orders.systemID)
+									WHERE price != excluded.price OR orderQty != excluded.orderQty OR locationID != excluded.locationID
+										OR (excluded.systemID IS NOT NULL AND orders.systemID IS NOT excluded.systemID)''', (timestamp,)).rowcount
+
+	conn.execute('''DROP TABLE temp.newsnapshot''')
+
+	return added, upserted - added, removed
+
+def initauxDB(clear=False):
+	# bring the aux DB schema up to date in place, keeping everything looked up so far unless clear
+	global _auxstore
+
+	with _auxstore_lock:
+		if _auxstore is not None:
+			_auxstore.close()
+			_auxstore = None
+
+		conn = sqlitetools.connect(DBFILE_AUX)
+		oldversion, newversion = sqlitetools.migrate(conn, AUXDB_MIGRATIONS)
+		if clear:
+			with conn:
+				for table in auxstore.TABLES: conn.execute('''DELETE FROM {}'''.format(table))
+		conn.close()
+
+	logger.debug('Initialised aux DB (schema v{} -> v{}{})'.format(oldversion, newversion, (', cleared' if clear else '')))
+
+def gethttpcache():
+	# one response cache for the whole process, opened on first use
+	global _httpcache
+
+	with _httpcache_lock:
+		if _httpcache is None: _httpcache = httpcache.HTTPCache(HTTPCACHE_FILE, maxbytes=HTTPCACHE_MAXBYTES)
+
+	return _httpcache
+
+def reqget(url, params=None, timeout=10, max_attempts=5, wait_between_attempts=2, session=None, usecache=True):
 	attempts = 0
 	while attempts < max_attempts:
 		attempts += 1
 		
 		try:
 			t1 = time.time()
-			if session is not None:
+			if usecache:
+				resp = gethttpcache().get(url, params=params, timeout=timeout, session=session)
+			elif session is not None:
 				resp = session.get(url, params=params, timeout=timeout)
 			else:
 				resp = requests.get(url, params=params, timeout=timeout)
@@ -133,146 +255,176 @@ def isstructureID(locationID):
 	else:
 		return False
 
-@lru_cache(maxsize=None)
-def getlocationinfo(locationID):
-	def getstationinfo(swaggerclient, stationID):
-		data = swaggerclient.request(app.op['get_universe_stations_station_id'](station_id=stationID)).data
+def getstationinfo(swaggerclient, stationID):
+	data = swaggerclient.request(app.op['get_universe_stations_station_id'](station_id=stationID)).data
 
-		if not data: raise Exception('Could not find system for station: {}'.format(stationID))
+	if not data: raise Exception('Could not find system for station: {}'.format(stationID))
 
-		return {'systemID': data['solar_system_id'], 'locationname': data['station_name']}
+	return {'systemID': data['solar_system_id'], 'locationname': data['station_name']}
 
-	def getstructureinfo(swaggerclient, structureID):
-		# data = swaggerclient.request(app.op['get_universe_structures_structure_id'](structure_id=structureID)).data
+def getstructureinfo(swaggerclient, structureID):
+	# data = swaggerclient.request(app.op['get_universe_structures_structure_id'](structure_id=structureID)).data
 
-		# !TODO: get structure info
-		logger.warning('Structure info not implemented (locationID: {})'.format(structureID))
+	# !TODO: get structure info
+	logger.warning('Structure info not implemented (locationID: {})'.format(structureID))
 
-		# if not data: raise Exception('Could not find system for station: {}'.format(structureID))
+	# if not data: raise Exception('Could not find system for station: {}'.format(structureID))
 
-		return {'systemID': None, 'locationname': None}
+	return {'systemID': None, 'locationname': None}
 
-	if not os.path.isfile(DBFILE_AUX): initauxDB()
+def fetchlocationinfo(locationID):
+	# look up a location from the API
+	try:
+		if not isstructureID(locationID):
+			return getstationinfo(swaggerclient, locationID)
+		else:
+			return getstructureinfo(swaggerclient, locationID)
+	except:
+		logger.error('Encountered error at location {}'.format(locationID))
+		raise
 
-	with sqlitetools.sqlite3.connect(DBFILE_AUX) as conn:
-		c = conn.cursor()
-		locationinfo = c.execute('''SELECT systemID,locationName FROM locations WHERE locationID = ?''', (locationID, )).fetchall()
+def getauxstore():
+	# one AuxStore for the whole process, opened on first use
+	global _auxstore
 
-		if locationinfo:
-			locationinfo = locationinfo[0]
-			locationinfo = {'systemID': locationinfo[0], 'locationname': locationinfo[1]}
+	with _auxstore_lock:
+		if _auxstore is None:
+			initauxDB()
+			_auxstore = auxstore.AuxStore(DBFILE_AUX)
 
-		else:
-			try:
-				if not isstructureID(locationID):
-					locationinfo = getstationinfo(swaggerclient, locationID)
-				else:
-					locationinfo = getstructureinfo(swaggerclient, locationID)
-			except:
-				logger.error('Encountered error at location {}'.format(locationID))
-				raise
+	return _auxstore
 
-			else:
-				c.execute('''INSERT INTO locations VALUES (?,?,?)''', (locationID, locationinfo['systemID'], locationinfo['locationname']))
-				conn.commit()
-				
-				logger.debug('{} -> {} ({}) (locations DB updated)'.format(locationID, locationinfo['systemID'], locationinfo['locationname']))
+def resolvelocations(locationIDs, cache=None, max_workers=MAX_WORKERS):
+	# locationID -> system: one DB read for everything we already know, then look up the rest from the API concurrently
+	# returns {locationID: locationinfo}; if a cache dict is given, anything already in it is skipped and it's updated with the results
+	locationIDs = set(locationIDs)
+	if cache is not None: locationIDs -= cache.keys()
 
-	conn.close()
+	if not locationIDs: return ({} if cache is None else cache)
 
-	return locationinfo
+	store = getauxstore()
+	locationinfo = {k: {'systemID': v[0], 'locationname': v[1]} for k, v in store.getmany('locations', locationIDs).items()}
+
+	unknown = [ii for ii in locationIDs if ii not in locationinfo]
+	if unknown:
+		t1 = time.time()
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			newinfo = dict(zip(unknown, executor.map(fetchlocationinfo, unknown)))
+
+		store.putmany('locations', ((k, (v['systemID'], v['locationname'])) for k, v in newinfo.items()))
+
+		locationinfo.update(newinfo)
+
+		logger.debug('Resolved {} new locations in {:.2f} sec (locations DB updated)'.format(len(newinfo), time.time() - t1))
+
+	if cache is not None:
+		cache.update(locationinfo)
+		return cache
+	else:
+		return locationinfo
 
 @lru_cache(maxsize=None)
 def getsysteminfo(systemID):
-	if not os.path.isfile(DBFILE_AUX): initauxDB()
-
-	with sqlitetools.sqlite3.connect(DBFILE_AUX) as conn:
-		c = conn.cursor()
-		systeminfo = c.execute('''SELECT systemName,security FROM systems WHERE systemID=?''', (systemID,)).fetchall()
+	store = getauxstore()
+	systeminfo = store.get('systems', systemID)
 
-		if systeminfo:
-			systeminfo = systeminfo[0]
-			systeminfo = {'name': systeminfo[0], 'security': systeminfo[1]}
+	if systeminfo:
+		systeminfo = {'name': systeminfo[0], 'security': systeminfo[1]}
 
+	else:
+		try:
+			url = 'https://crest-tq.eveonline.com/solarsystems/{}/'.format(systemID)
+			data = reqget(url).json()
+			systeminfo = {'name': data['name'], 'security': data['securityStatus']}
+		except:
+			logger.error('Encountered error for system: {}'.format(systemID))
+			raise
 		else:
-			try:
-				url = 'https://crest-tq.eveonline.com/solarsystems/{}/'.format(systemID)
-				data = reqget(url).json()
-				systeminfo = {'name': data['name'], 'security': data['securityStatus']}
-			except:
-				logger.error('Encountered error for system: {}'.format(systemID))
-				raise
-			else:
-				c.execute('''INSERT INTO systems VALUES (?,?,?)''', (systemID, systeminfo['name'], systeminfo['security']))
-				conn.commit()
-				
-				logger.debug('{} -> {}, {:.1f} (system DB updated)'.format(systemID, systeminfo['name'], systeminfo['security']))
-
-	conn.close()
+			store.put('systems', systemID, (systeminfo['name'], systeminfo['security']))
+			
+			logger.debug('{} -> {}, {:.1f} (system DB updated)'.format(systemID, systeminfo['name'], systeminfo['security']))
 
 	return systeminfo
 
+def initjumpgraph(jumpsfile=SDEFILE_JUMPS, systemsfile=SDEFILE_SYSTEMS):
+	# load stargates from the static data export into the aux DB and precompute jump counts for every pair of systems
+	store = getauxstore()
+	store.flush()
+
+	ngates, nsystems = jumpgraph.loadstargates(DBFILE_AUX, jumpsfile, systemsfile)
+	logger.debug('Loaded {} stargates, {} systems'.format(ngates, nsystems))
+
+	graph, t = jumpgraph.buildfromDB(DBFILE_AUX)
+	logger.debug('Built jump matrices for {} systems in {:.2f} sec'.format(len(graph.systems), t))
+
+	getjumpgraph.cache_clear()
+	getsysteminfo.cache_clear()
+	getjumps.cache_clear()
+
+@lru_cache(maxsize=None)
+def getjumpgraph():
+	# returns None if initjumpgraph has never been run
+	getauxstore()
+	return jumpgraph.JumpGraph.fromDB(DBFILE_AUX)
+
 @lru_cache(maxsize=None)
 def getjumps(waypoints, highseconly):
 	if len(waypoints) > 2: raise Exception('Not implemented')
 
 	system1, system2 = min(waypoints), max(waypoints)
 
-	if not os.path.isfile(DBFILE_AUX): initauxDB()
+	graph = getjumpgraph()
+	if graph is not None:
+		jumps = graph.jumps(system1, system2, highseconly)
+		# no highsec route, take the shortest one instead (like dotlan's safest route does)
+		if jumps is None and highseconly: jumps = graph.jumps(system1, system2, False)
+		if jumps is None: raise Exception('No route found for waypoints: {}'.format(waypoints))
 
-	with sqlitetools.sqlite3.connect(DBFILE_AUX) as conn:
-		c = conn.cursor()
-		jumps = c.execute('''SELECT jumps FROM jumps WHERE system1=? AND system2=? AND highsecOnly=?''', (system1, system2, highseconly)).fetchall()
+		return jumps
 
-		if jumps:
-			jumps = len(jumps[0])
+	# no local graph, fall back to asking dotlan
+	store = getauxstore()
+	jumps = store.get('jumps', (system1, system2, highseconly))
 
-		else:
-			try:
-				jumps = len(dotlanroutescraper.getroute((system1, system2), highseconly))
-			except:
-				logger.error('Encountered error for waypoints: {}'.format(waypoints))
-				raise
+	if jumps:
+		jumps = jumps[0]
 
-			else:
-				c.execute('''INSERT INTO jumps VALUES (?,?,?,?)''', (system1, system2, highseconly, jumps))
-				conn.commit()
-				
-				logger.debug('{} -> {} ({}) is {} jumps (jumps DB updated)'.format(system1, system2, ('safest' if highseconly else 'shortest'), jumps))
+	else:
+		try:
+			jumps = len(dotlanroutescraper.getroute((system1, system2), highseconly))
+		except:
+			logger.error('Encountered error for waypoints: {}'.format(waypoints))
+			raise
 
-	conn.close()
+		else:
+			store.put('jumps', (system1, system2, highseconly), (jumps,))
+			
+			logger.debug('{} -> {} ({}) is {} jumps (jumps DB updated)'.format(system1, system2, ('safest' if highseconly else 'shortest'), jumps))
 
 	return jumps
 
 @lru_cache(maxsize=None)
 def getiteminfo(itemID):
-	if not os.path.isfile(DBFILE_AUX): initauxDB()
+	store = getauxstore()
+	iteminfo = store.get('items', itemID)
 
-	with sqlitetools.sqlite3.connect(DBFILE_AUX) as conn:
-		c = conn.cursor()
-		iteminfo = c.execute('''SELECT itemName,volume FROM items WHERE itemID=?''', (itemID,)).fetchall()
+	if iteminfo:
+		iteminfo = {'name': iteminfo[0], 'volume': iteminfo[1]}
 
-		if iteminfo:
-			iteminfo = iteminfo[0]
-			iteminfo = {'name': iteminfo[0], 'volume': iteminfo[1]}
-
-		else:
-			try:
-				url = 'https://crest-tq.eveonline.com/inventory/types/{}/'.format(itemID)
-				data = reqget(url).json()
-				iteminfo = {'name': data['name'], 'volume': data['volume']}
-
-			except:
-				logger.error('Encountered error for item: {}'.format(itemID))
-				raise
+	else:
+		try:
+			url = 'https://crest-tq.eveonline.com/inventory/types/{}/'.format(itemID)
+			data = reqget(url).json()
+			iteminfo = {'name': data['name'], 'volume': data['volume']}
 
-			else:
-				c.execute('''INSERT INTO items VALUES (?,?,?)''', (itemID, iteminfo['name'], iteminfo['volume']))
-				conn.commit()
-				
-				logger.debug('{} -> {} ({} m3) (item DB updated)'.format(itemID, iteminfo['name'], iteminfo['volume']))
+		except:
+			logger.error('Encountered error for item: {}'.format(itemID))
+			raise
 
-	conn.close()
+		else:
+			store.put('items', itemID, (iteminfo['name'], iteminfo['volume']))
+			
+			logger.debug('{} -> {} ({} m3) (item DB updated)'.format(itemID, iteminfo['name'], iteminfo['volume']))
 
 	return iteminfo
 
@@ -291,35 +443,11 @@ def getregionorders_swagger(swaggerclient, region, item=None, ordertype=None, pa
 
 	return orders
 
-def getregionorders_req(region, item=None, ordertype='all', page='all', session=None, API=None):
-	if ordertype not in ('buy', 'sell', 'all'): raise Exception('ordertype must be "buy", "sell" or "all"')
-	
-	API = API.lower()
-
+def requestorderpage(region, item=None, ordertype='all', page=1, API=None, session=None):
+	# download a single page of region orders, returns the raw response
 	if API == 'esi':
-		if page == 'all':
-			orders = []
-			page = 1
-			thispage = getregionorders_req(region, item, ordertype, page, session=session)
-			while thispage:
-				orders.extend(thispage)
-				page += 1
-				thispage = getregionorders_req(region, item, ordertype, page, session=session)
-
-		else:
-			url = 'https://esi.tech.ccp.is/latest/markets/{}/orders/'.format(region)
-			params = {'type_id': item, 'order_type': ordertype, 'page': page}
-
-			resp = reqget(url, params, session=session)
-			orders = resp.json()
-
-			orders_trim = tuple(Order(orderID=ii['order_id'],
-										itemID=ii['type_id'],
-										orderType=('buy' if ii['is_buy_order'] else 'sell'),
-										price=ii['price'],
-										orderQty=ii['volume_remain'],
-										locationID=ii['location_id'])
-								for ii in orders)
+		url = 'https://esi.tech.ccp.is/latest/markets/{}/orders/'.format(region)
+		params = {'type_id': item, 'order_type': ordertype, 'page': page}
 
 	elif API == 'crest':
 		if item in ('all', None):
@@ -328,182 +456,642 @@ def getregionorders_req(region, item=None, ordertype='all', page='all', session=
 			itemURL_CREST = 'https://crest-tq.eveonline.com/inventory/types/{}/'.format(item)
 
 		url = 'https://crest-tq.eveonline.com/market/{}/orders/{}/'.format(region, itemURL_CREST)
-		params = ({'page': page} if page != 'all' else None)
+		params = {'page': page}
 
-		resp = reqget(url, params, session=session)
+	else:
+		raise Exception('Invalid API: {}'.format(API))
+
+	return reqget(url, params, session=session)
+
+def decodeorderpage(resp, API):
+	# returns (rows, total no. of pages if the API tells us, whether there might be another page)
+	if API == 'esi':
+		rows = resp.json()
+		npages = resp.headers.get('X-Pages')
+
+		return rows, (int(npages) if npages else None), bool(rows)
+
+	elif API == 'crest':
 		data = resp.json()
-		orders = data['items']
-
-		if page == 'all':
-			uniq_orderids = set()
-			while 'next' in data:
-				url = data['next']['href']
-				resp = reqget(url, params, session=session)
-				data = resp.json()
-				# sometimes we get orders duplicated between pages - this will ignore duplicates, giving preference to the earlier appearance
-				for oo in data['items']:
-					oo_id = oo['id']
-					if oo_id not in uniq_orderids:
-						uniq_orderids.add(oo_id)
-						orders.append(oo)
+
+		return data['items'], data.get('pageCount'), ('next' in data)
+
+	else:
+		raise Exception('Invalid API: {}'.format(API))
+
+def getorderpage(region, item=None, ordertype='all', page=1, API=None, session=None):
+	# fetch and decode a single page of region orders
+	return decodeorderpage(requestorderpage(region, item, ordertype, page, API, session), API)
+
+def getregionorderpages(region, item=None, ordertype='all', API=None, session=None, executor=None):
+	# get all pages of orders for a region, in page order
+	# the first page tells us how many pages there are, the rest are fetched in parallel if we're given an executor
+	rows, npages, more = getorderpage(region, item, ordertype, 1, API, session)
+	pages = [rows]
+
+	if npages:
+		getpage = lambda pp: getorderpage(region, item, ordertype, pp, API, session)[0]
+		if executor is not None:
+			pages.extend(executor.map(getpage, range(2, npages+1)))
+		else:
+			pages.extend(getpage(pp) for pp in range(2, npages+1))
+
+	else:
+		# page count unknown, walk pages until we run out
+		page = 1
+		while more:
+			page += 1
+			rows, _, more = getorderpage(region, item, ordertype, page, API, session)
+			pages.append(rows)
+
+	return pages
+
+def fetchorderpages(regionIDs, API, session=None, max_workers=MAX_WORKERS, progress=None):
+	# fetch all pages of orders for several regions concurrently, using at most max_workers requests at a time
+	# page 1 of every region goes out first; once we know how many pages a region has, the rest of its pages are queued up
+	# progress(stage, done, total): optional callback, anything it raises aborts the fetch
+	# returns {regionID: [page1rows, page2rows, ...]}, pages in order
+	pages = {rr: {} for rr in regionIDs}
+	ndone = 0
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		pending = {executor.submit(getorderpage, rr, None, 'all', 1, API, session): (rr, 1) for rr in regionIDs}
+
+		try:
+			while pending:
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+				for future in done:
+					region, page = pending.pop(future)
+					rows, npages, more = future.result()
+					pages[region][page] = rows
+					ndone += 1
+
+					if page == 1 and npages:
+						for pp in range(2, npages+1):
+							pending[executor.submit(getorderpage, region, None, 'all', pp, API, session)] = (region, pp)
+					elif npages is None and more:
+						pending[executor.submit(getorderpage, region, None, 'all', page+1, API, session)] = (region, page+1)
+
+				if progress is not None: progress('Pages downloaded', ndone, ndone + len(pending))
+		except BaseException:
+			executor.shutdown(wait=False, cancel_futures=True) # don't sit through the rest of the queue
+			raise
+
+	return {rr: [pages[rr][pp] for pp in sorted(pages[rr])] for rr in regionIDs}
+
+def trimrow(row, API):
+	# pull the fields we care about out of a raw API row, in orders table column order:
+	# (orderID, itemID, locationID, orderType, price, orderQty)
+	orderID, itemID, locationID, isbuy, price, orderQty = (row[ii] for ii in ORDERFIELDS[API])
+
+	return (orderID, itemID, locationID, ('buy' if isbuy else 'sell'), price, orderQty)
+
+def makefilter(rowfilter=None, ignore_contraband=False):
+	# returns an OrderFilter (or None if there's nothing to filter), with contraband added to the deny list if asked
+	if ignore_contraband: rowfilter = (rowfilter or orderfilter.OrderFilter()).withdeny(contraband_types)
+	return rowfilter
+
+def filterrows(rows, rowfilter=None, cache=None):
+	# apply an OrderFilter to trimmed rows and attach systems, dropping rows where the system is unknown
+	# cheap checks go first so rows we don't want never cost a location lookup
+	# returns rows of (orderID, itemID, locationID, orderType, price, orderQty, systemID)
+	keep = (rowfilter.rowpredicate() if rowfilter is not None else None)
+	rows = ([ii for ii in rows if keep(ii)] if keep is not None else list(rows))
+
+	locationinfo = resolvelocations((ii[2] for ii in rows), cache=cache)
+	rows = [ii + (locationinfo[ii[2]]['systemID'],) for ii in rows if locationinfo[ii[2]]['systemID']]
+
+	if rowfilter is not None and rowfilter.needssecurity():
+		secure = set(rowfilter.securesystems((ii[6] for ii in rows), securityof=(lambda systemID: getsysteminfo(systemID)['security'])))
+		rows = [ii for ii in rows if ii[6] in secure]
+
+	return rows
+
+def trimorders(pages, API, ordertype='all', rowfilter=None):
+	# turn pages of raw API rows into Orders, skipping anything rowfilter (an OrderFilter) doesn't want
+	if API not in ORDERFIELDS: raise Exception('Invalid API: {}'.format(API))
+
+	rows = (trimrow(ii, API) for page in pages for ii in page)
+
+	if API == 'crest':
+		# sometimes we get orders duplicated between pages - this will ignore duplicates, giving preference to the earlier appearance
+		uniq_orderids = set()
+		rows_uniq = []
+		for row in rows:
+			if row[0] not in uniq_orderids:
+				uniq_orderids.add(row[0])
+				rows_uniq.append(row)
+		rows = rows_uniq
 
 		if ordertype != 'all':
-			ordertype = (True if ordertype == 'buy' else False)
-			orders = [ii for ii in orders if ii['buy'] == ordertype]
+			rows = [ii for ii in rows if ii[3] == ordertype]
 
-		orders_trim = tuple(Order(orderID=ii['id'],
-									itemID=ii['type'],
-									orderType=('buy' if ii['buy'] else 'sell'),
-									price=ii['price'],
-									orderQty=ii['volume'],
-									locationID=ii['stationID'])
-							for ii in orders)
+	rows = filterrows(rows, rowfilter) # also strips orders where system is unknown
 
-	orders_trim = tuple(ii for ii in orders_trim if ii.systemID) # strip orders where system is unknown
+	return tuple(Order(orderID=ii[0], itemID=ii[1], locationID=ii[2], orderType=ii[3], price=ii[4], orderQty=ii[5], systemID=ii[6]) for ii in rows)
 
-	return orders_trim
+def getregionorders_req(region, item=None, ordertype='all', page='all', session=None, API=None, executor=None, rowfilter=None):
+	if ordertype not in ('buy', 'sell', 'all'): raise Exception('ordertype must be "buy", "sell" or "all"')
+	
+	API = API.lower()
+
+	if page == 'all':
+		pages = getregionorderpages(region, item, ordertype, API=API, session=session, executor=executor)
+	else:
+		pages = [getorderpage(region, item, ordertype, page, API=API, session=session)[0]]
+
+	return trimorders(pages, API, ordertype, rowfilter)
 
-def getorderdata(ignore_contraband, API, use_swagger_interface=False):
-	regionlist = CREST_getregions('empire')
+def getorderdata(ignore_contraband, API, use_swagger_interface=False, max_workers=MAX_WORKERS, rowfilter=None, progress=None):
+	# rowfilter: OrderFilter, applied to raw rows before any Order is made
+	# progress(stage, done, total): optional callback, anything it raises aborts the pull
+	rowfilter = makefilter(rowfilter, ignore_contraband)
+	regionlist = {k: v for k, v in CREST_getregions('empire').items() if rowfilter is None or rowfilter.keepregion(k)}
 	orders = []
 	with requests.Session() as sesh:
-		for regionID in regionlist:
-			logger.debug('Doing region: {}'.format(regionlist[regionID]))
-			if API == 'ESI' and use_swagger_interface:
+		if API == 'ESI' and use_swagger_interface:
+			for regionID in regionlist:
+				logger.debug('Doing region: {}'.format(regionlist[regionID]))
 				orders.extend(getregionorders_swagger(regionID, session=sesh, API=API))
-			else:
-				orders.extend(getregionorders_req(regionID, session=sesh, API=API))
-			logger.debug('Got {} orders'.format(len(orders)))
+				logger.debug('Got {} orders'.format(len(orders)))
+
+		else:
+			# let every worker keep its own connection open
+			sesh.mount('https://', requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers))
+
+			t1 = time.time()
+			regionpages = fetchorderpages(regionlist, API.lower(), session=sesh, max_workers=max_workers, progress=progress)
+			logger.debug('Fetched {} pages for {} regions in {:.2f} sec'.format(sum(len(ii) for ii in regionpages.values()), len(regionlist), time.time() - t1))
 
-			if ignore_contraband: orders = [ii for ii in orders if ii.itemID not in contraband_types]
+			for nn, regionID in enumerate(regionlist, start=1):
+				logger.debug('Doing region: {}'.format(regionlist[regionID]))
+				orders.extend(trimorders(regionpages[regionID], API.lower(), rowfilter=rowfilter))
+				logger.debug('Got {} orders'.format(len(orders)))
+				if progress is not None: progress('Regions processed', nn, len(regionlist))
+
+			logger.debug('HTTP cache: {}'.format(gethttpcache().stats()))
 	
 	return orders
 
-def writeorderstoDB(orders):
-	initorderDB()
-	sqlitetools.insertmany(DBFILE_ORDERS, 'orders', [(ii.orderID, ii.itemID, ii.locationID, ii.orderType, ii.price, ii.orderQty) for ii in orders])
+def ingestorders(API, ignore_contraband=False, max_workers=MAX_WORKERS, queuesize=pipeline.QUEUE_SIZE, batchsize=INSERT_BATCH_SIZE, rowfilter=None, progress=None):
+	# stream all empire orders straight into the order DB:
+	# page counts -> page download -> JSON decode -> trim -> filter + location resolution -> batched insert
+	# every stage runs concurrently and only ever holds a few queues' worth of pages, not the whole universe
+	# progress(stage, done, total): optional callback, anything it raises aborts the ingest before the orders table is touched
+	API = API.lower()
+	rowfilter = makefilter(rowfilter, ignore_contraband)
+	regionlist = {k: v for k, v in CREST_getregions('empire').items() if rowfilter is None or rowfilter.keepregion(k)}
+
+
+	with requests.Session() as sesh, connectorderDB(check_same_thread=False) as conn:
+		opensnapshot(conn)
+		sesh.mount('https://', requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers))
+
+		def firstpages(region):
+			resp = requestorderpage(region, page=1, API=API, session=sesh)
+			rows, npages, more = decodeorderpage(resp, API)
+			yield (region, 1, resp)
+
+			if npages:
+				for pp in range(2, npages+1): yield (region, pp, None)
+			else:
+				# page count unknown, walk pages until we run out
+				page = 1
+				while more:
+					page += 1
+					resp = requestorderpage(region, page=page, API=API, session=sesh)
+					rows, _, more = decodeorderpage(resp, API)
+					yield (region, page, resp)
+
+		def download(item):
+			region, page, resp = item
+			if resp is None: resp = requestorderpage(region, page=page, API=API, session=sesh)
+			yield resp
+
+		def decode(resp):
+			yield decodeorderpage(resp, API)[0]
+
+		def trim(rows):
+			yield [trimrow(ii, API) for ii in rows]
+
+		locationinfo = {}
+		def resolve(rows):
+			# only one worker, resolvelocations does its own lookups concurrently
+			yield filterrows(rows, rowfilter, cache=locationinfo) # also strips orders where system is unknown
+
+		ingest = pipeline.Pipeline(regionlist, queuesize=queuesize)
+		ingest.addstage(firstpages, workers=max_workers)
+		ingest.addstage(download, workers=max_workers)
+		ingest.addstage(decode, workers=2)
+		ingest.addstage(trim)
+		ingest.addstage(resolve)
+
+		def staged():
+			nstaged = 0
+			for rows in ingest.run():
+				yield from rows
+				nstaged += len(rows)
+				if progress is not None: progress('Orders ingested', nstaged, None)
+
+		t1 = time.time()
+		# CREST can repeat orders between pages, first one in wins
+		norders, rate = sqlitetools.bulkinsert(conn, 'newsnapshot', staged(), chunksize=batchsize, conflict='IGNORE')
+		added, changed, removed = applysnapshot(conn)
 
-def readordersfromDB():
-	with sqlitetools.sqlite3.connect(DBFILE_ORDERS) as conn:
-		c = conn.cursor()
-		allorders = c.execute('''SELECT orderID,itemID,locationID,orderType,price,orderQty FROM orders''').fetchall()
 	conn.close()
 
-	allorders = [Order(orderID=ii[0], itemID=ii[1], locationID=ii[2], orderType=ii[3], price=ii[4], orderQty=ii[5]) for ii in allorders]
+	writesnapshotfile()
 
-	logger.debug('Read {} orders from DB'.format(len(allorders)))
+	logger.debug('Ingested {} orders from {} regions in {:.2f} sec, staged at {:,.0f} rows/sec ({} new, {} changed, {} removed)'.format(norders, len(regionlist), time.time() - t1, rate, added, changed, removed))
+	logger.debug('HTTP cache: {}'.format(gethttpcache().stats()))
 
-	return allorders
+	return norders
 
-def findtrades(orders):
-	alltrades = []
+def writeorderstoDB(orders, timestamp=None, progress=None):
+	# incremental save, only orders that are new, changed or gone touch the orders table
+	# the snapshot file is rewritten to match
+	# progress(stage, done, total): optional callback while orders are staged, anything it raises aborts the save
+	# before the orders table is touched
+	if timestamp is None: timestamp = time.time()
+	book = (orders if isinstance(orders, orderbook.OrderBook) else orderbook.OrderBook.fromorders(orders))
 
-	idc_dict = {ii.itemID:{'buy':{}, 'sell':{}} for ii in orders}
-	for ii,oo in enumerate(orders):
-		if oo.systemID not in idc_dict[oo.itemID][oo.orderType]: idc_dict[oo.itemID][oo.orderType][oo.systemID] = []
-		idc_dict[oo.itemID][oo.orderType][oo.systemID].append(ii)
+	t1 = time.time()
+	with connectorderDB() as conn:
+		opensnapshot(conn)
+		norders, rate = sqlitetools.bulkinsert(conn, 'newsnapshot', book.rows(), conflict='IGNORE',
+												progress=(None if progress is None else (lambda done: progress('Orders staged', done, len(book)))))
+		added, changed, removed = applysnapshot(conn, timestamp)
+	conn.close()
 
-	for this_item in idc_dict:
-		itemtrades = []
-		minsell, maxbuy = {}, {}
+	snapshotfile.write(SNAPSHOTFILE, book, timestamp)
+
+	logger.debug('Saved {} orders in {:.2f} sec, staged at {:,.0f} rows/sec ({} new, {} changed, {} removed)'.format(norders, time.time() - t1, rate, added, changed, removed))
+
+	return added, changed, removed
+
+def backfillsystems(conn):
+	# orders saved before the orders table had a systemID column: look their systems up once and store them (0 = unknown)
+	missing = [ii[0] for ii in conn.execute('''SELECT DISTINCT locationID FROM orders WHERE systemID IS NULL''')]
+	if not missing: return 0
+
+	locationinfo = resolvelocations(missing)
+	with conn:
+		conn.executemany('''UPDATE orders SET systemID=? WHERE locationID=? AND systemID IS NULL''', ((locationinfo[ll]['systemID'] or 0, ll) for ll in missing))
+
+	logger.debug('Stored systems for {} locations in the order DB'.format(len(missing)))
+
+	return len(missing)
+
+def findcandidatesSQL(conn, where='', params=()):
+	# the SQL version of columnar.findcandidates: per (item, buy/sell, system) best prices, and the (item, sell system, buy system)
+	# combinations where the cheapest sell beats the best buy, all inside SQLite off the orders_book index
+	# where, params: optional filter on orders (aliased o), as from OrderFilter.sqlwhere
+	# fills temp.tradeable with every (itemID, orderType, systemID) book on at least one candidate route, returns the candidates
+	conn.execute('''DROP TABLE IF EXISTS temp.books''')
+	conn.execute('''DROP TABLE IF EXISTS temp.tradeable''')
+	conn.execute('''CREATE TEMP TABLE books AS SELECT o.itemID, o.orderType, o.systemID, MIN(o.price) AS minprice, MAX(o.price) AS maxprice
+					FROM orders o {} {} o.systemID > 0 GROUP BY o.itemID, o.orderType, o.systemID'''.format(where, ('AND' if where else 'WHERE')), params)
+	conn.execute('''CREATE INDEX temp.books_item ON books (itemID, orderType)''')
+
+	candidates = conn.execute('''SELECT s.itemID, s.systemID, b.systemID FROM books s JOIN books b ON b.itemID = s.itemID AND b.orderType = 'buy'
+								WHERE s.orderType = 'sell' AND s.minprice < b.maxprice''').fetchall()
+
+	conn.execute('''CREATE TEMP TABLE tradeable (itemID INT, orderType TEXT, systemID INT, PRIMARY KEY (itemID, orderType, systemID)) WITHOUT ROWID''')
+	conn.executemany('''INSERT OR IGNORE INTO temp.tradeable VALUES (?,?,?)''', ((ii[0], tt, ii[kk]) for ii in candidates for tt, kk in (('sell', 1), ('buy', 2))))
+	conn.execute('''DROP TABLE temp.books''')
+
+	return candidates
+
+def readorderchunks(conn, rowfilter=None, chunksize=READ_CHUNK_SIZE, tradeableonly=False):
+	# one scan of orders JOINed to the aux DB's locations (attached to conn as aux), as OrderBooks of up to chunksize orders
+	# only locations the aux DB has never seen cost a lookup
+	# see readordersfromDB for rowfilter and tradeableonly
+	where, params = ('', [])
+	if rowfilter is not None:
+		systems = None
+		if rowfilter.needssecurity():
+			# the band is checked in Python like at ingest, looking up systems the aux DB hasn't seen yet instead of dropping their orders
+			backfillsystems(conn)
+			systems = rowfilter.securesystems([ii[0] for ii in conn.execute('''SELECT DISTINCT systemID FROM orders''')], securityof=(lambda systemID: getsysteminfo(systemID)['security']))
+
+		where, params = rowfilter.sqlwhere(alias='o', systems=systems)
+		if rowfilter.regions is not None: logger.warning('Region filter ignored, the order DB has no regions')
+
+	c = conn.cursor()
+
+	join = ''
+	if tradeableonly:
+		t1 = time.time()
+		backfillsystems(conn)
+		candidates = findcandidatesSQL(conn, where, params)
+		join = '''JOIN temp.tradeable t ON t.itemID = o.itemID AND t.orderType = o.orderType AND t.systemID = o.systemID'''
+		logger.debug('Found {} candidate system pairs in SQL in {:.2f} sec'.format(len(candidates), time.time() - t1))
+
+	c.execute('''SELECT o.orderID,o.itemID,o.locationID,o.orderType,o.price,o.orderQty,
+				o.systemID IS NOT NULL OR l.locationID IS NOT NULL, COALESCE(o.systemID, l.systemID)
+				FROM orders o {} LEFT JOIN aux.locations l ON o.locationID = l.locationID {}'''.format(join, where), params)
+
+	while True:
+		rows = c.fetchmany(chunksize)
+		if not rows: break
+
+		book, unresolved = orderbook.OrderBook(), []
+		for row in rows:
+			if not row[6]: unresolved.append(row[:6])
+			elif row[7]: book.append(*row[:6], systemID=row[7]) # known location, unknown system: drop it
+
+		if unresolved:
+			logger.debug('Resolving {} orders at locations not in the aux DB'.format(len(unresolved)))
+			book.extend(filterrows(unresolved))
+
+		yield book
+
+def readordersfromDB(rowfilter=None, chunksize=READ_CHUNK_SIZE, tradeableonly=False):
+	# the whole order DB (or what's left of it after rowfilter) in one OrderBook, see readorderchunks
+	# rowfilter: OrderFilter, turned into a WHERE clause so filtered orders never leave SQLite
+	# tradeableonly: only load orders in books that can trade at a profit somewhere (see findcandidatesSQL),
+	# findtrades gives the same answer on these as on the whole table
+	t1 = time.time()
+	getauxstore().flush() # so the join sees everything resolved so far
+	book = orderbook.OrderBook()
 
-		for sellsystem in idc_dict[this_item]['sell']:
-			for buysystem in idc_dict[this_item]['buy']:
-				sellorders, buyorders = [orders[ii] for ii in idc_dict[this_item]['sell'][sellsystem]], [orders[ii] for ii in idc_dict[this_item]['buy'][buysystem]]
+	with connectorderDB() as conn:
+		conn.execute('''ATTACH DATABASE ? AS aux''', (DBFILE_AUX,))
+		for chunk in readorderchunks(conn, rowfilter, chunksize, tradeableonly): book.extendbook(chunk)
+	conn.close()
 
-				if sellsystem not in minsell: minsell[sellsystem] = min(ii.price for ii in sellorders)
-				if buysystem not in maxbuy: maxbuy[buysystem] = max(ii.price for ii in buyorders)
+	logger.debug('Read {} orders from DB in {:.2f} sec'.format(len(book), time.time() - t1))
 
-				if minsell[sellsystem] < maxbuy[buysystem]:
-					itemtrades.extend(fillorders(sellorders, buyorders))
+	return book
 
-		logger.debug('Item {}: found {} trades'.format(this_item, len(itemtrades)))
+def writesnapshotfile(timestamp=None, chunksize=READ_CHUNK_SIZE, progress=None):
+	# stream the order DB into the snapshot file a chunk at a time, so it's never all in memory at once
+	# progress(stage, done, total): optional callback per chunk, anything it raises aborts the write and leaves the old file
+	# returns no. of orders written
+	t1 = time.time()
+	getauxstore().flush()
 
-		alltrades.extend(itemtrades)
+	with connectorderDB() as conn:
+		conn.execute('''ATTACH DATABASE ? AS aux''', (DBFILE_AUX,))
+		conn.execute('''BEGIN''') # the count and the scan see the same orders
+		capacity = conn.execute('''SELECT COUNT(*) FROM orders''').fetchone()[0]
 
-	return alltrades
+		def chunks():
+			done = 0
+			for chunk in readorderchunks(conn, chunksize=chunksize):
+				yield chunk
+				done += len(chunk)
+				if progress is not None: progress('Orders read', done, capacity)
+
+		norders = snapshotfile.write(SNAPSHOTFILE, chunks(), timestamp, capacity)
+	conn.close()
+
+	logger.debug('Wrote {} orders to {} in {:.2f} sec'.format(norders, SNAPSHOTFILE, time.time() - t1))
+
+	return norders
+
+def loadorders(rowfilter=None, progress=None):
+	# the latest order snapshot, from the snapshot file (mapped, so nothing is parsed or copied and every process
+	# shares the page cache), made from the order DB first if there isn't one yet
+	# rowfilter: OrderFilter, applied to the mapped columns in one pass, only the orders kept are copied
+	# progress(stage, done, total): optional callback, anything it raises aborts the load
+	if not os.path.isfile(SNAPSHOTFILE): writesnapshotfile(progress=progress)
+
+	t1 = time.time()
+	book, timestamp = snapshotfile.read(SNAPSHOTFILE)
+
+	if rowfilter is not None:
+		if progress is not None: progress('Filtering orders', 0, len(book))
+		if rowfilter.regions is not None: logger.warning('Region filter ignored, the order snapshot has no regions')
+		keep = rowfilter.columnmask(columnar.OrderColumns.frombook(book), securityof=(lambda systemID: getsysteminfo(systemID)['security']))
+		book = columnar.takebook(book, np.flatnonzero(keep))
+
+	if progress is not None: progress('Orders loaded', len(book), len(book))
+	logger.debug('Loaded {} orders from snapshot of {} in {:.2f} sec'.format(len(book), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), time.time() - t1))
+
+	return book
+
+def jumpfilter(max_jumps, highseconly, stats=None):
+	# pair filter for columnar.findcandidates: keeps (sell system, buy system) pairs no more than max_jumps apart
+	# needs the jump matrices (see initjumpgraph), returns None without them - asking dotlan about every pair would take forever
+	graph = getjumpgraph()
+	if graph is None: return None
+
+	if stats is None: stats = {}
+	stats.update(pairs=0, dropped=0)
+
+	def keep(systems1, systems2):
+		jumps = columnar.pairjumps(graph, systems1, systems2, highseconly)
+		mask = jumps <= max_jumps
+		stats['pairs'] += len(mask)
+		stats['dropped'] += int(len(mask) - mask.sum())
+		return mask
 
-def fillorders(sellorders, buyorders):
-	if len(set(ii.systemID for ii in sellorders)) > 1: raise Exception('Mismatched sell systems: {}'.format(set(ii.systemID for ii in sellorders)))
-	if len(set(ii.systemID for ii in buyorders)) > 1: raise Exception('Mismatched buy systems: {}'.format(set(ii.systemID for ii in buyorders)))
-	if len(set(ii.itemID for ii in (sellorders+buyorders))) > 1: raise Exception('Mismatched items: {}'.format(set(ii.itemID for ii in (sellorders+buyorders))))
+	return keep
 
-	sellorders = sorted(sellorders, key=attrgetter('price'), reverse=False) # sell orders low -> high
-	buyorders = sorted(buyorders, key=attrgetter('price'), reverse=True) # buy orders high -> low
+def findtrades(orders, max_jumps=None, highseconly=False, progress=None):
+	# only profitable (item, sell system, buy system) combinations ever get as far as fillorders, see columnar.findcandidates
+	# max_jumps: skip sell/buy systems further apart than this (by highsec-only routes if highseconly)
+	# progress(stage, done, total): optional callback, anything it raises aborts the search
+	alltrades = []
+
+	t1 = time.time()
+	stats = {}
+	pairfilter = (None if max_jumps is None else jumpfilter(max_jumps, highseconly, stats))
+	if max_jumps is not None and pairfilter is None: logger.warning('No jump graph, ignoring max_jumps={} (see initjumpgraph)'.format(max_jumps))
+	candidates, books = columnar.findcandidates(columnar.OrderColumns.fromorders(orders), pairfilter)
+	logger.debug('Found {} candidate system pairs in {:.2f} sec'.format(len(candidates), time.time() - t1))
+	if pairfilter is not None: logger.debug('Jump radius {} ({}) dropped {} of {} profitable system pairs before matching'.format(max_jumps, ('safest' if highseconly else 'shortest'), stats['dropped'], stats['pairs']))
+
+	# each (item, system) book is sorted once and shared by every pair it's in
+	books = {gg: [orders[ii] for ii in idc] for gg, idc in books.items()}
+
+	itemtrades, this_item = [], None
+	for nn, (itemID, sellgroup, buygroup) in enumerate(candidates, start=1):
+		if progress is not None: progress('System pairs matched', nn, len(candidates))
+
+		if itemID != this_item:
+			if itemtrades: logger.debug('Item {}: found {} trades'.format(this_item, len(itemtrades)))
+			alltrades.extend(itemtrades)
+			itemtrades, this_item = [], itemID
+
+		itemtrades.extend(fillorders(books[sellgroup], books[buygroup], presorted=True))
+
+	if itemtrades: logger.debug('Item {}: found {} trades'.format(this_item, len(itemtrades)))
+	alltrades.extend(itemtrades)
+
+	return alltrades
+
+def fillorders(sellorders, buyorders, presorted=False):
+	# match sell orders (low -> high) against buy orders (high -> low)
+	# presorted: caller guarantees the books are already in that order, all for one item and one system per side
+	if not presorted:
+		sellsystems, buysystems, items = set(), set(), set()
+		for oo in sellorders:
+			sellsystems.add(oo.systemID)
+			items.add(oo.itemID)
+		for oo in buyorders:
+			buysystems.add(oo.systemID)
+			items.add(oo.itemID)
+
+		if len(sellsystems) > 1: raise Exception('Mismatched sell systems: {}'.format(sellsystems))
+		if len(buysystems) > 1: raise Exception('Mismatched buy systems: {}'.format(buysystems))
+		if len(items) > 1: raise Exception('Mismatched items: {}'.format(items))
+
+		sellorders = sorted(sellorders, key=attrgetter('price'), reverse=False) # sell orders low -> high
+		buyorders = sorted(buyorders, key=attrgetter('price'), reverse=True) # buy orders high -> low
 
 	trades = []
 
-	tracker = {}
-	for order in (sellorders + buyorders):
-		tracker[order.orderID] = order.orderQty
+	# walk both books once: ss is the cheapest sell order that still has stock
+	sellremaining = [ii.orderQty for ii in sellorders]
+	ss, nsell = 0, len(sellorders)
 
-	# logger.debug('Item: {}, sell system: {}, buysystem: {}'.format(sellorders[0].itemID, sellorders[0].systemID, buyorders[0].systemID))
 	for bb in buyorders:
-		for ss in sellorders:
-			if tracker[bb.orderID] <= 0: break
-			if ss.price >= bb.price: break
+		buyremaining = bb.orderQty
+
+		while buyremaining > 0 and ss < nsell:
+			sellorder = sellorders[ss]
+			if sellorder.price >= bb.price: break
 
-			if tracker[ss.orderID] <= 0: continue
+			if sellremaining[ss] <= 0:
+				ss += 1
+				continue
 
-			tradeqty = min(tracker[ss.orderID], tracker[bb.orderID])
+			tradeqty = min(sellremaining[ss], buyremaining)
 
-			trades.append(Trade(ss, bb, tradeqty))
+			trades.append(Trade(sellorder, bb, tradeqty))
 
-			# logger.debug('Sell order: {}, {}/{} units @ {} -> Buy order: {}, {}/{} units @ {}'.format(ss.orderID, tradeqty, tracker[ss.orderID], ss.price, bb.orderID, tradeqty, tracker[bb.orderID], bb.price))
+			sellremaining[ss] -= tradeqty
+			buyremaining -= tradeqty
 
-			tracker[ss.orderID] -= tradeqty
-			tracker[bb.orderID] -= tradeqty
+		# buy orders only get cheaper from here, so if this one can't be filled neither can the rest
+		if ss >= nsell or sellorders[ss].price >= bb.price: break
 	
 	return trades
 
-def findtrips(trades, maxvol, minprofitpertrip, minprofitpertrade, minprofitperjump, highseconly):
+def groupbyroute(trades):
+	# {(startsystem, endsystem): [trades]}
+	routes = {}
+	for trade in trades:
+		route = (trade.sellorder.systemID, trade.buyorder.systemID)
+		if route not in routes: routes[route] = []
+		routes[route].append(trade)
+
+	return routes
+
+def packtrip(startsystem, endsystem, trades, maxvol, minprofitpertrade, capital=None):
+	# load up a trip with the most profitable cargo that fits in maxvol (and costs no more than capital, if given), see packer.pack
+	this_trip = Trip(startsystem, endsystem)
+
+	# unit volumes are looked up once per trade, then it's all arrays
+	# best profit per m3 first, ties are broken by order IDs so the result doesn't depend on the order trades were found in
+	trades_thistrip = [(ii.itemvol(), ii) for ii in trades if ii.profit() >= minprofitpertrade]
+	trades_thistrip.sort(key=lambda x: (-round(x[1].profitperunit() / x[0], 2), x[1].sellorder.orderID, x[1].buyorder.orderID))
+	if not trades_thistrip: return this_trip
+
+	qty = packer.pack(unitvol=[ii[0] for ii in trades_thistrip],
+						unitprofit=[ii[1].profitperunit() for ii in trades_thistrip],
+						maxqty=[ii[1].tradeqty for ii in trades_thistrip],
+						maxvol=maxvol,
+						unitcost=[ii[1].sellorder.price for ii in trades_thistrip],
+						capital=capital)
+
+	for (itemvol, this_trade), units in zip(trades_thistrip, qty.tolist()):
+		if units > 0: this_trip.addtrade(this_trade, units)
+
+	return this_trip
+
+def keeptrip(trip, minprofitpertrip, minprofitperjump, highseconly):
+	return trip.profit() >= minprofitpertrip and trip.profitperjump(highseconly) >= minprofitperjump
+
+def routebound(trades, maxvol, minprofitpertrade):
+	# cheap upper bound on what packtrip could make on a route: fill maxvol with fractional units, best profit per m3 first
+	bound, vol_remaining = 0, maxvol
+	for itemvol, profitperunit, tradeqty in sorted(((ii.itemvol(), ii.profitperunit(), ii.tradeqty) for ii in trades if ii.profit() >= minprofitpertrade), key=lambda x: x[1] / x[0], reverse=True):
+		if vol_remaining <= 0: break
+
+		units = min(tradeqty, vol_remaining / itemvol)
+		bound += units * profitperunit
+		vol_remaining -= units * itemvol
+
+	return bound
+
+def findtrips(trades, maxvol, minprofitpertrip, minprofitpertrade, minprofitperjump, highseconly, capital=None, topk=None, rankby='profit', progress=None, ontrip=None):
+	# topk: only return the best K trips by rankby ('profit' or 'profitperjump'), best first
+	# progress(stage, done, total): optional callback, anything it raises aborts the search
+	# ontrip(trip): optional, called with each trip as soon as it's found (not with topk, trips can still drop out then)
+	# routes are tried in order of an upper bound on their profit, and skipped without packing when even that bound can't
+	# make the thresholds or beat the worst trip we're already keeping
+	if rankby not in ('profit', 'profitperjump'): raise Exception('rankby must be "profit" or "profitperjump"')
 
 	alltrips = []
+	heap = []
 
-	idc_dict = {}
-	for ii,trade in enumerate(trades):
-		ss, bb = trade.sellorder.systemID, trade.buyorder.systemID
+	t1 = time.time()
+	routes = []
+	for (startsystem, endsystem), trades_thistrip in groupbyroute(trades).items():
+		bound = routebound(trades_thistrip, maxvol, minprofitpertrade)
+		if bound < minprofitpertrip: continue # before looking up jumps, that can mean asking dotlan
 
-		if ss not in idc_dict: idc_dict[ss] = {}
-		if bb not in idc_dict[ss]: idc_dict[ss][bb] = []
+		jumps = (1 if startsystem == endsystem else getjumps((startsystem, endsystem), highseconly))
+		if bound / jumps < minprofitperjump: continue
 
-		idc_dict[ss][bb].append(ii)
+		routes.append(((bound if rankby == 'profit' else bound / jumps), startsystem, endsystem, trades_thistrip))
 
-	for startsystem in idc_dict:
-		for endsystem in idc_dict[startsystem]:
-			this_trip = Trip(startsystem, endsystem)
+	routes.sort(key=itemgetter(0), reverse=True)
+	npacked = 0
 
-			trades_thistrip = [trades[ii] for ii in idc_dict[startsystem][endsystem]]
-			trades_thistrip.sort(key=lambda x: x.profitperm3(), reverse=True)
+	for rank, (bound, startsystem, endsystem, trades_thistrip) in enumerate(routes):
+		if topk is not None and len(heap) >= topk and bound <= heap[0][0]: break # sorted by bound, so nothing after this can get in either
 
-			vol_remaining = maxvol
-			ii = -1
-			while vol_remaining > 0:
-				ii += 1
-				if ii >= len(trades_thistrip): break
-				
-				this_trade = trades_thistrip[ii]
-				if this_trade.profit() < minprofitpertrade: continue
+		if progress is not None: progress('Routes evaluated', rank, len(routes))
 
-				if this_trade.totalvol() > vol_remaining:
-					tradeqty_reduced = int(vol_remaining / this_trade.itemvol())
-					if tradeqty_reduced <= 0:
-						continue
-					else:
-						this_trade.tradeqty = tradeqty_reduced
+		this_trip = packtrip(startsystem, endsystem, trades_thistrip, maxvol, minprofitpertrade, capital)
+		npacked += 1
+
+		if keeptrip(this_trip, minprofitpertrip, minprofitperjump, highseconly):
+			if topk is None:
+				alltrips.append(this_trip)
+				if ontrip is not None: ontrip(this_trip)
+			else:
+				score = (this_trip.profit() if rankby == 'profit' else this_trip.profitperjump(highseconly))
+				if len(heap) < topk:
+					heapq.heappush(heap, (score, -rank, this_trip))
+				elif score > heap[0][0]:
+					heapq.heapreplace(heap, (score, -rank, this_trip))
 
-				this_trip.addtrade(this_trade)
-				vol_remaining -= this_trade.totalvol()
+	if progress is not None: progress('Routes evaluated', len(routes), len(routes))
+	logger.debug('Packed {}/{} candidate routes in {:.2f} sec'.format(npacked, len(routes), time.time() - t1))
 
-			if this_trip.profit() >= minprofitpertrip:
-				if this_trip.profitperjump(highseconly) >= minprofitperjump:
-					alltrips.append(this_trip)
+	if topk is not None: alltrips = [ii[2] for ii in sorted(heap, reverse=True)]
 
 	return alltrips
 
+def diffsnapshots(oldorders, neworders):
+	# compare two snapshots by orderID
+	# returns (added orders, changed orders, removed orderIDs); changed means price or quantity moved
+	old = {oo.orderID: oo for oo in oldorders}
+	added, changed = [], []
+
+	seen = set()
+	for oo in neworders:
+		seen.add(oo.orderID)
+		prev = old.get(oo.orderID)
+		if prev is None:
+			added.append(oo)
+		elif prev.price != oo.price or prev.orderQty != oo.orderQty:
+			changed.append(oo)
+
+	removed = [ii for ii in old if ii not in seen]
+
+	return added, changed, removed
+
 class Order:
+	__slots__ = ('orderID', 'itemID', 'orderType', 'price', 'orderQty', 'locationID', 'systemID')
 
-	def __init__(self, orderID, itemID, orderType, price, orderQty, locationID):
+	def __init__(self, orderID, itemID, orderType, price, orderQty, locationID, systemID=None):
 		self.orderID = orderID
 		self.itemID = itemID
 		self.orderType = orderType
@@ -511,63 +1099,135 @@ class Order:
 		self.orderQty = orderQty
 		self.locationID = locationID
 
-		self.systemID = getlocationinfo(self.locationID)['systemID']
+		self.systemID = systemID # from the location, resolved in bulk (resolvelocations) when orders are ingested or read from the DB
+
+	def __getstate__(self):
+		return {name: getattr(self, name) for name in self.__slots__}
+
+	def __setstate__(self, state):
+		if isinstance(state, tuple): state = dict(state[0] or {}, **state[1]) # pickled with the default slots state
+		for name in self.__slots__: setattr(self, name, state.get(name))
 
 class Trade:
+	# profit and volume are kept up to date as tradeqty changes, so reading them is just an attribute lookup
+	# the item volume is looked up on first use and then kept, most trades never get that far
+	# a trade in a trip belongs to that trip alone (see Trip.addtrade) and tells it when tradeqty changes
+	__slots__ = ('sellorder', 'buyorder', 'itemID', '_tradeqty', '_profitperunit', '_profit', '_itemvol', '_totalvol', '_trip')
 
-	def __init__(self, sellorder, buyorder, tradeqty):
+	def __init__(self, sellorder, buyorder, tradeqty, itemvol=None):
 		self.sellorder = sellorder
 		self.buyorder = buyorder
-		self.tradeqty = tradeqty
 		self.itemID = sellorder.itemID
 
+		self._profitperunit = round(buyorder.price - sellorder.price, 2)
+		self._itemvol = itemvol
+		self._trip = None # the trip that owns this trade, if any
+		self.tradeqty = tradeqty
+
+	def __getstate__(self):
+		return {'sellorder': self.sellorder, 'buyorder': self.buyorder, 'tradeqty': self._tradeqty, 'itemvol': self._itemvol}
+
+	def __setstate__(self, state):
+		if isinstance(state, tuple): state = dict(state[0] or {}, **state[1]) # pickled before the running totals
+		self.__init__(state['sellorder'], state['buyorder'], state['tradeqty'], state.get('itemvol'))
+
 	def __str__(self):
 		return 'Item: {}, {} ({}) -> {} ({}), {:,.2f} x {} units = {:,.2f} ISK'.format(self.itemID, self.sellorder.systemID, self.sellorder.orderID, self.buyorder.systemID, self.buyorder.orderID, self.buyorder.price - self.sellorder.price, self.tradeqty, self.profit())
 
+	@property
+	def tradeqty(self):
+		return self._tradeqty
+
+	@tradeqty.setter
+	def tradeqty(self, tradeqty):
+		self._tradeqty = tradeqty
+		self._profit = self._profitperunit * tradeqty
+		self._totalvol = (None if self._itemvol is None else self._itemvol * tradeqty)
+
+		if self._trip is not None: self._trip.retotal()
+
 	def profitperunit(self):
-		return round(self.buyorder.price - self.sellorder.price, 2)
+		return self._profitperunit
 
 	def profit(self):
-		return self.profitperunit() * self.tradeqty
+		return self._profit
 
 	def profitperm3(self):
-		return round(self.profitperunit() / getiteminfo(self.itemID)['volume'], 2)
+		return round(self._profitperunit / self.itemvol(), 2)
 
 	def itemvol(self):
-		return getiteminfo(self.itemID)['volume']
+		if self._itemvol is None:
+			itemvol = getiteminfo(self.itemID)['volume']
+			self._totalvol = itemvol * self._tradeqty
+			self._itemvol = itemvol
+
+		return self._itemvol
 
 	def totalvol(self):
-		return self.itemvol() * self.tradeqty
+		totalvol = self._totalvol
+		return (self.itemvol() * self._tradeqty if totalvol is None else totalvol)
 	
 class Trip:
+	# profit and volume are running totals kept by addtrade (and by the trades, see Trade.tradeqty),
+	# jumps are looked up once per highseconly
+	__slots__ = ('startsystem', 'endsystem', 'trades', '_profit', '_totalvol', '_jumps')
 
 	def __init__(self, startsystem, endsystem):
 		self.startsystem = startsystem
 		self.endsystem = endsystem
 
 		self.trades = []
+		self._profit = 0
+		self._totalvol = 0
+		self._jumps = {} # highseconly: jumps
+
+	def __getstate__(self):
+		return {'startsystem': self.startsystem, 'endsystem': self.endsystem, 'trades': self.trades}
 
-	def addtrade(self, trade):
+	def __setstate__(self, state):
+		if isinstance(state, tuple): state = dict(state[0] or {}, **state[1]) # pickled before the running totals
+		self.__init__(state['startsystem'], state['endsystem'])
+		for trade in state['trades']: self.addtrade(trade)
+
+	def addtrade(self, trade, tradeqty=None):
+		# the trip keeps its own copy of trade (with tradeqty units, if given), the trade passed in is never touched -
+		# trades are shared between trips, and between threads in the web app
 		if isinstance(trade, Trade):
 			if trade.sellorder.systemID == self.startsystem and trade.buyorder.systemID == self.endsystem:
+				trade = Trade(trade.sellorder, trade.buyorder, (trade.tradeqty if tradeqty is None else tradeqty), trade.itemvol())
+				trade._trip = self
+
 				self.trades.append(trade)
+				self._profit += trade.profit()
+				self._totalvol += trade.totalvol()
 			else:
 				raise Exception('Trade does not fit with this trip. Expected systems: {} -> {}. Trade: {} -> {}'.format(self.startsystem, self.endsystem,
-																														trade.sellsystem, trade.buysystem))
+																														trade.sellorder.systemID, trade.buyorder.systemID))
 		else:
 			raise Exception('Not a trade: {}'.format(trade))
 
+	def retotal(self):
+		# add the totals up again from scratch, for when a trade's quantity changed
+		self._profit = sum([ii.profit() for ii in self.trades])
+		self._totalvol = sum([ii.totalvol() for ii in self.trades])
+
 	def profit(self):
-		return round(sum([ii.profit() for ii in self.trades]), 2)
+		return round(self._profit, 2)
 
 	def totalvol(self):
-		return sum([ii.totalvol() for ii in self.trades])
+		return self._totalvol
+
+	def jumps(self, highseconly):
+		jumps = self._jumps.get(highseconly)
+		if jumps is None: jumps = self._jumps[highseconly] = getjumps((self.startsystem, self.endsystem), highseconly)
+
+		return jumps
 
 	def profitperjump(self, highseconly):
 		if self.startsystem == self.endsystem:
 			ppj = self.profit()
 		else:
-			ppj = round(self.profit() / getjumps((self.startsystem, self.endsystem), highseconly), 2)
+			ppj = round(self.profit() / self.jumps(highseconly), 2)
 		
 		return ppj
 
@@ -576,11 +1236,96 @@ class Trip:
 				'startsystem': self.startsystem,
 				'endsystem': self.endsystem,
 				'profit': self.profit(),
-				'jumps': getjumps((self.startsystem, self.endsystem), highseconly),
+				'jumps': self.jumps(highseconly),
 				'profitperjump': self.profitperjump(highseconly),
-				'totalvol': self.totalvol(),
+				'totalvol': self._totalvol,
 				}
 
+class TradeFinder:
+	# keeps trades per item and trips per route between refreshes,
+	# so feeding it an order delta only redoes the items that changed and the routes those items trade on
+
+	def __init__(self, orders, maxvol, minprofitpertrip, minprofitpertrade, minprofitperjump, highseconly, capital=None, max_jumps=None):
+		self.maxvol = maxvol
+		self.capital = capital
+		self.max_jumps = max_jumps
+		if max_jumps is not None and getjumpgraph() is None:
+			logger.warning('No jump graph, ignoring max_jumps={} (see initjumpgraph)'.format(max_jumps))
+			self.max_jumps = None
+		self.minprofitpertrip = minprofitpertrip
+		self.minprofitpertrade = minprofitpertrade
+		self.minprofitperjump = minprofitperjump
+		self.highseconly = highseconly
+
+		self.orders = {}
+		self.itemorders = {} # itemID: {orderID: order}
+		self.itemroutes = {} # itemID: routes this item's trades are on
+		self.routetrades = {} # route: {itemID: [trades]}
+		self.trips = {} # route: Trip, only those that pass the thresholds
+
+		self.update(added=orders)
+
+	def refresh(self, neworders):
+		# swap in a whole new snapshot, only the differences get reprocessed
+		return self.update(*diffsnapshots(self.orders.values(), neworders))
+
+	def update(self, added=(), changed=(), removed=()):
+		# added, changed: orders; removed: orderIDs
+		# returns routes whose trips were recomputed
+		t1 = time.time()
+		items = set()
+
+		for orderID in removed:
+			oo = self.orders.pop(orderID, None)
+			if oo is None: continue
+			del self.itemorders[oo.itemID][orderID]
+			items.add(oo.itemID)
+
+		for oo in list(added) + list(changed):
+			# a changed order keeps its place among its item's orders, that's what decides which of two equal prices fills first
+			prev = self.orders.get(oo.orderID)
+			if prev is not None and prev.itemID != oo.itemID:
+				del self.itemorders[prev.itemID][oo.orderID]
+				items.add(prev.itemID)
+			self.orders[oo.orderID] = oo
+			self.itemorders.setdefault(oo.itemID, {})[oo.orderID] = oo
+			items.add(oo.itemID)
+
+		routes = set()
+		for itemID in items:
+			for route in self.itemroutes.pop(itemID, ()):
+				del self.routetrades[route][itemID]
+				routes.add(route)
+
+			itemorders = self.itemorders.get(itemID)
+			if not itemorders:
+				self.itemorders.pop(itemID, None)
+				continue
+
+			for route, trades in groupbyroute(findtrades(list(itemorders.values()), self.max_jumps, self.highseconly)).items():
+				self.routetrades.setdefault(route, {})[itemID] = trades
+				self.itemroutes.setdefault(itemID, set()).add(route)
+				routes.add(route)
+
+		for route in routes:
+			self.trips.pop(route, None)
+
+			itemtrades = self.routetrades.get(route)
+			if not itemtrades:
+				self.routetrades.pop(route, None)
+				continue
+
+			this_trip = packtrip(route[0], route[1], [trade for trades in itemtrades.values() for trade in trades], self.maxvol, self.minprofitpertrade, self.capital)
+			if keeptrip(this_trip, self.minprofitpertrip, self.minprofitperjump, self.highseconly):
+				self.trips[route] = this_trip
+
+		logger.debug('Recomputed {} items, {} routes in {:.2f} sec'.format(len(items), len(routes), time.time() - t1))
+
+		return routes
+
+	def alltrips(self):
+		return list(self.trips.values())
+
 if __name__ == '__main__':
 
 	import customlog
@@ -599,8 +1344,8 @@ if __name__ == '__main__':
 	# writeorderstoDB(orders)
 
 	t1 = time.time()
-	orders = readordersfromDB()
-	logger.info('Read orders from DB in {:.2f} sec'.format(time.time() - t1))
+	orders = loadorders()
+	logger.info('Loaded orders in {:.2f} sec'.format(time.time() - t1))
 
 	t1 = time.time()
 	trades = findtrades(orders)
@@ -1,21 +1,280 @@
 #!/usr/bin/env python3
 
-from flask import Flask, render_template, jsonify
+import gzip
+import hashlib
+import json
+import math
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from flask import Flask, Response, jsonify, render_template, request
+from werkzeug.http import http_date
+
+import customlog
+logger = customlog.initlogger('mylogger', console=True, loglevel='debug')
+
+import evetrade
+
+TRIPS_PICKLE = 'trips_temp.pkl' # used if there's no order snapshot yet
+TRIP_PARAMS = {'maxvol': 60e3, 'minprofitpertrip': 20e6, 'minprofitpertrade': 900e3, 'minprofitperjump': 900e3, 'highseconly': True}
+
+REFRESH_INTERVAL = 10 # sec between checks for a new snapshot
+FIRST_BUILD_WAIT = 30 # sec a request waits for the very first build before giving up with a 503
+
+QUERY_CACHE_SIZE = 64 # /trips results kept, least recently used go first
+SORT_KEYS = ('profit', 'profitperjump', 'totalvol', 'jumps')
+
 app = Flask(__name__)
- 
+
+_tripscache = None # see gettripscache
+_tripscache_lock = threading.Lock()
+
+_tripqueries = None # see gettripqueries
+_tripqueries_lock = threading.Lock()
+
+class TripsCache:
+	# the /gettrips payload, serialised and gzipped once per snapshot by a background thread
+	# so requests only ever copy bytes out of memory
+
+	def __init__(self, interval=REFRESH_INTERVAL):
+		self.interval = interval
+
+		self._lock = threading.Lock()
+		self._ready = threading.Event()
+		self._source = None # (path, mtime) the payload was built from
+		self.payload = None # dict: body, gzipped, etag, lastmodified
+
+		self._thread = threading.Thread(target=self._run, name='tripscache', daemon=True)
+		self._thread.start()
+
+	@staticmethod
+	def currentsource():
+		# the snapshot file if there is one, otherwise the old trips pickle
+		for path in (evetrade.SNAPSHOTFILE, TRIPS_PICKLE):
+			if os.path.isfile(path): return path, os.stat(path).st_mtime_ns
+		return None
+
+	@staticmethod
+	def tripsfrom(source):
+		# returns (source the trips really came from, trips)
+		path, mtime = source
+		if path == TRIPS_PICKLE:
+			with open(path, 'rb') as infile: return source, pickle.load(infile)
+
+		# same trades /trips uses, so there's only ever one set per snapshot
+		mtime, trades = gettripqueries().trades()
+		if trades is None: raise Exception('{} went away'.format(path))
+
+		return (path, mtime), evetrade.findtrips(trades, **TRIP_PARAMS)
+
+	def rebuild(self, source):
+		t1 = time.time()
+
+		source, trips = self.tripsfrom(source)
+		path, mtime = source
+		body = json.dumps([ii.attr_dict(highseconly=TRIP_PARAMS['highseconly']) for ii in trips]).encode()
+		etag = hashlib.sha1(body).hexdigest()
+
+		payload = {'body': body, 'gzipped': gzip.compress(body), 'etag': etag, 'lastmodified': mtime / 1e9}
+
+		with self._lock:
+			self.payload, self._source = payload, source
+		self._ready.set()
+
+		logger.debug('Rebuilt /gettrips from {}: {} trips, {} bytes ({} gzipped) in {:.2f} sec'.format(path, len(trips), len(body), len(payload['gzipped']), time.time() - t1))
+
+	def _run(self):
+		while True:
+			source = self.currentsource()
+
+			if source is not None and source != self._source:
+				try:
+					self.rebuild(source)
+				except Exception:
+					logger.exception('Failed to rebuild trips from {}, still serving the previous ones'.format(source[0]))
+
+			time.sleep(self.interval)
+
+	def get(self, timeout=FIRST_BUILD_WAIT):
+		# returns the current payload, or None if there's nothing yet
+		self._ready.wait(timeout)
+		with self._lock:
+			return self.payload
+
+def gettripscache():
+	# one cache (and refresh thread) per process, started on first use
+	global _tripscache
+
+	with _tripscache_lock:
+		if _tripscache is None: _tripscache = TripsCache()
+
+	return _tripscache
+
+class TripQueries:
+	# answers /trips queries from one set of trades per order snapshot, found once and shared by every query (and /gettrips)
+	# results are memoised by their normalised parameters, and identical queries that arrive together share one computation
+
+	def __init__(self, maxsize=QUERY_CACHE_SIZE):
+		self.maxsize = maxsize
+
+		self._lock = threading.Lock()
+		self._memo = OrderedDict() # key: sorted rows, most recently used last
+		self._inflight = {} # key: Future, for queries being computed right now
+		self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+		self._tradeslock = threading.Lock()
+		self._source = None
+		self._trades = None
+
+	def trades(self):
+		# returns (snapshot version, trades), reloading if the snapshot has changed since last time
+		if not os.path.isfile(evetrade.SNAPSHOTFILE): return None, None
+		source = os.stat(evetrade.SNAPSHOTFILE).st_mtime_ns
+
+		with self._tradeslock:
+			if source != self._source:
+				t1 = time.time()
+				self._trades = evetrade.findtrades(evetrade.loadorders())
+				self._source = source
+
+				with self._lock:
+					self._memo.clear() # nothing in there can be asked for again
+
+				logger.debug('Loaded {} trades for /trips in {:.2f} sec'.format(len(self._trades), time.time() - t1))
+
+			return self._source, self._trades
+
+	def _memoised(self, key, compute):
+		with self._lock:
+			if key in self._memo:
+				self._memo.move_to_end(key)
+				self.stats['hits'] += 1
+				return self._memo[key]
+
+			future = self._inflight.get(key)
+			owner = (future is None)
+			if owner:
+				future = self._inflight[key] = Future()
+				self.stats['misses'] += 1
+			else:
+				self.stats['coalesced'] += 1
+
+		if not owner: return future.result()
+
+		try:
+			result = compute()
+		except Exception as e:
+			with self._lock: del self._inflight[key]
+			future.set_exception(e)
+			raise
+
+		with self._lock:
+			del self._inflight[key]
+			self._memo[key] = result
+			while len(self._memo) > self.maxsize: self._memo.popitem(last=False)
+
+		future.set_result(result)
+
+		return result
+
+	def query(self, params):
+		# params: from parsetripquery, minus offset/limit
+		# returns all matching trips as dicts, sorted, or None if there's no snapshot
+		source, trades = self.trades()
+		if trades is None: return None
+
+		def compute():
+			t1 = time.time()
+			trips = evetrade.findtrips(trades, maxvol=params['maxvol'], minprofitpertrip=params['minprofitpertrip'], minprofitpertrade=params['minprofitpertrade'],
+										minprofitperjump=params['minprofitperjump'], highseconly=params['highseconly'], capital=params['capital'])
+			rows = [ii.attr_dict(highseconly=params['highseconly']) for ii in trips]
+			rows.sort(key=lambda row: row[params['sort']], reverse=params['descending'])
+			logger.debug('/trips {}: {} trips in {:.2f} sec'.format(params, len(rows), time.time() - t1))
+			return rows
+
+		return self._memoised((source,) + tuple(sorted(params.items())), compute)
+
+def gettripqueries():
+	global _tripqueries
+
+	with _tripqueries_lock:
+		if _tripqueries is None: _tripqueries = TripQueries()
+
+	return _tripqueries
+
+def parsetripquery(args):
+	# normalise /trips query args, so the same query always makes the same cache key
+	# returns (params, offset, limit), raises ValueError on bad input
+	def number(name, default):
+		value = float(args.get(name, default))
+		if not math.isfinite(value) or value < 0: raise ValueError('{} must be a finite number >= 0'.format(name))
+		return value
+
+	params = {name: number(name, TRIP_PARAMS[name]) for name in ('maxvol', 'minprofitpertrip', 'minprofitpertrade', 'minprofitperjump')}
+	params['capital'] = (number('capital', 0) or None) if 'capital' in args else None
+	params['highseconly'] = args.get('highseconly', str(TRIP_PARAMS['highseconly'])).lower() in ('1', 'true', 'yes', 'on')
+
+	params['sort'] = args.get('sort', 'profit')
+	if params['sort'] not in SORT_KEYS: raise ValueError('sort must be one of: {}'.format(', '.join(SORT_KEYS)))
+	params['descending'] = (args.get('order', 'desc').lower() != 'asc')
+
+	offset = int(args.get('offset', 0))
+	limit = (int(args['limit']) if 'limit' in args else None)
+	if offset < 0 or (limit is not None and limit < 0): raise ValueError('offset and limit must be >= 0')
+
+	return params, offset, limit
+
 @app.route("/")
 def index():
 	return render_template('index.html')
 
 @app.route("/gettrips")
 def loadtrips():
-	import pickle
-	# with open('trips_temp.pkl', 'wb') as outfile: pickle.dump(trips, outfile)
-	with open('trips_temp.pkl', 'rb') as infile: trips = pickle.load(infile)
-	
-	resp = jsonify([ii.attr_dict(highseconly=True) for ii in trips])
-	
-	return resp
+	payload = gettripscache().get()
+	if payload is None: return Response('No trips yet', status=503, headers={'Retry-After': str(REFRESH_INTERVAL)})
+
+	# the gzipped body is a different representation, so it gets its own ETag
+	gzipped = ('gzip' in request.accept_encodings)
+	etag = payload['etag'] + ('-gzip' if gzipped else '')
+
+	headers = {
+		'ETag': '"{}"'.format(etag),
+		'Last-Modified': http_date(payload['lastmodified']),
+		'Cache-Control': 'no-cache', # always revalidate, it's cheap
+		'Vary': 'Accept-Encoding',
+		}
+
+	notmodified = (request.if_none_match.contains(etag) if request.if_none_match else
+					request.if_modified_since is not None and request.if_modified_since.timestamp() >= int(payload['lastmodified']))
+	if notmodified: return Response(status=304, headers=headers)
+
+	if gzipped: headers['Content-Encoding'] = 'gzip'
+
+	return Response(payload['gzipped'] if gzipped else payload['body'], mimetype='application/json', headers=headers)
+
+@app.route("/trips")
+def trips():
+	# ?maxvol=&minprofitpertrip=&minprofitpertrade=&minprofitperjump=&highseconly=&capital=&sort=&order=asc|desc&offset=&limit=&format=json|ndjson
+	try:
+		params, offset, limit = parsetripquery(request.args)
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+
+	rows = gettripqueries().query(params)
+	if rows is None: return Response('No order snapshot yet', status=503, headers={'Retry-After': str(REFRESH_INTERVAL)})
+
+	page = rows[offset:(None if limit is None else offset + limit)]
+	headers = {'X-Total-Count': str(len(rows))}
+
+	ndjson = (request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson')
+	if not ndjson: return Response(json.dumps(page), mimetype='application/json', headers=headers)
+
+	# one trip per line, sent as it's serialised so clients can show the first ones straight away
+	return Response((json.dumps(row) + '\n' for row in page), mimetype='application/x-ndjson', headers=headers)
 
 if __name__ == "__main__":
-	app.run(debug=True)
\ No newline at end of file
+	app.run(debug=True)
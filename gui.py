@@ -1,14 +1,71 @@
 #!/usr/bin/env python3
 
-from operator import itemgetter
+import threading
+import time
 
 import wx
 import wx.grid
+import wx.lib.newevent
 
 import customlog
 logger = customlog.initlogger('mylogger', console=True, loglevel='debug')
 
 import evetrade
+import orderfilter
+
+PROGRESS_INTERVAL = 0.2 # sec between progress updates (and batches of trips) from a running job
+
+# posted from worker threads, handled on the wx thread
+JobProgressEvent, EVT_JOB_PROGRESS = wx.lib.newevent.NewEvent() # job, stage, done, total
+JobDoneEvent, EVT_JOB_DONE = wx.lib.newevent.NewEvent() # job, result, error, cancelled
+TripsFoundEvent, EVT_TRIPS_FOUND = wx.lib.newevent.NewEvent() # job, rows
+
+class JobCancelled(Exception):
+	pass
+
+class Job(threading.Thread):
+	# runs func(job) on a worker thread and only ever talks back to window through posted events,
+	# so the wx thread never waits on the network, SQLite or the matching
+	# func reports through job.progress, which is also where a cancel() takes effect
+
+	def __init__(self, window, func, ondone=None, interval=PROGRESS_INTERVAL):
+		super().__init__(name='job', daemon=True)
+		self.window = window
+		self.func = func
+		self.ondone = ondone # called with the result on the wx thread
+		self.interval = interval
+
+		self._cancelled = threading.Event()
+		self._lastprogress = 0
+
+	def cancel(self):
+		self._cancelled.set()
+
+	def progress(self, stage, done=0, total=None):
+		# fits evetrade's progress callbacks; throttled, except the last step of a stage always gets through
+		if self._cancelled.is_set(): raise JobCancelled()
+
+		now = time.time()
+		if now - self._lastprogress < self.interval and not (total and done >= total): return
+		self._lastprogress = now
+
+		wx.PostEvent(self.window, JobProgressEvent(job=self, stage=stage, done=done, total=total))
+
+	def post(self, event):
+		wx.PostEvent(self.window, event)
+
+	def run(self):
+		result, error, cancelled = None, None, False
+
+		try:
+			result = self.func(self)
+		except JobCancelled:
+			cancelled = True
+		except Exception as e:
+			logger.exception('Job failed')
+			error = e
+
+		wx.PostEvent(self.window, JobDoneEvent(job=self, result=result, error=error, cancelled=cancelled))
 
 class MainWindow(wx.Frame):
 
@@ -53,6 +110,18 @@ class MainWindow(wx.Frame):
 
 		self.btn_pullorders.Bind(wx.EVT_BUTTON, self.PullOrders)
 		self.btn_saveorders.Bind(wx.EVT_BUTTON, self.SaveOrders)
+
+		# order data filters, applied while pulling so unwanted orders are never loaded
+		self.text_minordervalue = wx.TextCtrl(leftpanel)
+		self.text_minordervalue.SetValue('0')
+		text_minordervalue_units = wx.StaticText(leftpanel, label='ISK min. order value')
+		self.chk_ignorecontraband = wx.CheckBox(leftpanel, label='Ignore contraband')
+		self.chk_stationsonly = wx.CheckBox(leftpanel, label='Stations only')
+
+		self.chk_ignorecontraband.SetValue(True)
+
+		self.text_minordervalue.Bind(wx.EVT_SET_FOCUS, self.NumberBoxRemoveSeps)
+		self.text_minordervalue.Bind(wx.EVT_KILL_FOCUS, self.NumberBoxAddSeps)
 		
 		# filter controls
 		self.text_maxvol = wx.TextCtrl(leftpanel)
@@ -70,11 +139,25 @@ class MainWindow(wx.Frame):
 		
 		# go button
 		self.btn_gettrips = wx.Button(leftpanel, label='Get Trips')
-		# self.btn_gettrips.Disable()
+		self.btn_gettrips.Disable()
 		self.chk_highseconly = wx.CheckBox(leftpanel, label='Highsec only')
 
 		self.btn_gettrips.Bind(wx.EVT_BUTTON, self.GetTrips)
 
+		# job progress
+		self.gauge_job = wx.Gauge(leftpanel, range=100)
+		self.text_jobstatus = wx.StaticText(leftpanel, label='')
+		self.btn_canceljob = wx.Button(leftpanel, label='Cancel')
+		self.btn_canceljob.Disable()
+
+		self.btn_canceljob.Bind(wx.EVT_BUTTON, self.CancelJob)
+		self.Bind(EVT_JOB_PROGRESS, self.OnJobProgress)
+		self.Bind(EVT_JOB_DONE, self.OnJobDone)
+		self.Bind(EVT_TRIPS_FOUND, self.OnTripsFound)
+
+		self.job = None
+		self.orders = None
+
 		# results grid
 		self.tripgrid = CustomGrid(leftpanel)
 
@@ -86,6 +169,12 @@ class MainWindow(wx.Frame):
 		hbox1.Add(self.cb_datasource, 1, flag=wx.ALL, border=5)
 		hbox1.Add(self.btn_saveorders, 1, flag=wx.ALL, border=5)
 
+		hbox1b = wx.BoxSizer(wx.HORIZONTAL)
+		hbox1b.Add(self.text_minordervalue, 2, flag=wx.ALL, border=5)
+		hbox1b.Add(text_minordervalue_units, 2, flag=wx.ALL, border=5)
+		hbox1b.Add(self.chk_ignorecontraband, 2, flag=wx.ALL, border=5)
+		hbox1b.Add(self.chk_stationsonly, 2, flag=wx.ALL, border=5)
+
 		hbox2 = wx.StaticBoxSizer(wx.HORIZONTAL, leftpanel, label='Filters')
 		hbox2.Add(self.text_maxvol, 3, flag=wx.ALL, border=5)
 		hbox2.Add(text_maxvol_units, 1, flag=wx.ALL, border=5)
@@ -96,12 +185,19 @@ class MainWindow(wx.Frame):
 		hbox3.Add(self.btn_gettrips, 1, flag=wx.ALL, border=5)
 		hbox3.Add(self.chk_highseconly, 1, flag=wx.ALL, border=5)
 
+		hbox3b = wx.BoxSizer(wx.HORIZONTAL)
+		hbox3b.Add(self.gauge_job, 3, flag=wx.ALL, border=5)
+		hbox3b.Add(self.text_jobstatus, 3, flag=wx.ALL, border=5)
+		hbox3b.Add(self.btn_canceljob, 1, flag=wx.ALL, border=5)
+
 		hbox4 = wx.BoxSizer(wx.HORIZONTAL)
 		hbox4.Add(self.tripgrid, 1, flag=wx.ALL, border=5)
 
 		vbox_master.Add(hbox1, 1, flag=wx.EXPAND)
+		vbox_master.Add(hbox1b, 1, flag=wx.EXPAND)
 		vbox_master.Add(hbox2, 1, flag=wx.EXPAND)
 		vbox_master.Add(hbox3, 1, flag=wx.EXPAND)
+		vbox_master.Add(hbox3b, 1, flag=wx.EXPAND)
 		vbox_master.Add(hbox4, 1, flag=wx.EXPAND)
 
 		leftpanel.SetSizer(vbox_master)
@@ -120,7 +216,7 @@ class MainWindow(wx.Frame):
 		evetrade.initorderDB()
 
 	def InitAuxDB(self, evt):
-		evetrade.initauxDB()
+		evetrade.initauxDB(clear=True)
 
 	def NumberBoxAddSeps(self, evt):
 		widget = evt.GetEventObject()
@@ -134,66 +230,130 @@ class MainWindow(wx.Frame):
 		widget.ChangeValue(number.replace(',',''))
 		evt.Skip()
 
-	def PullOrders(self, evt):
-		waitcursor = wx.BusyCursor()
+	def StartJob(self, func, ondone, label):
+		# run func(job) in the background, one job at a time
+		if self.job is not None: return
+
+		for btn in (self.btn_pullorders, self.btn_saveorders, self.btn_gettrips): btn.Disable()
+		self.btn_canceljob.Enable()
+		self.text_jobstatus.SetLabel(label)
+		self.gauge_job.Pulse()
+
+		self.job = Job(self, func, ondone)
+		self.job.start()
+
+	def CancelJob(self, evt):
+		if self.job is not None:
+			self.job.cancel()
+			self.text_jobstatus.SetLabel('Cancelling...')
 
+	def OnJobProgress(self, evt):
+		if evt.job is not self.job: return
+
+		if evt.total:
+			self.gauge_job.SetRange(evt.total)
+			self.gauge_job.SetValue(min(evt.done, evt.total))
+			self.text_jobstatus.SetLabel('{}: {:,} / {:,}'.format(evt.stage, evt.done, evt.total))
+		else:
+			self.gauge_job.Pulse()
+			self.text_jobstatus.SetLabel('{}: {:,}'.format(evt.stage, evt.done))
+
+	def OnJobDone(self, evt):
+		if evt.job is not self.job: return
+		self.job = None
+
+		self.btn_canceljob.Disable()
+		self.gauge_job.SetValue(0)
+
+		if evt.cancelled:
+			self.text_jobstatus.SetLabel('Cancelled')
+		elif evt.error is not None:
+			self.text_jobstatus.SetLabel('Failed: {}'.format(evt.error))
+		else:
+			self.text_jobstatus.SetLabel('Done')
+			if evt.job.ondone is not None: evt.job.ondone(evt.result)
+
+		self.btn_pullorders.Enable()
+		if self.orders is not None:
+			self.btn_saveorders.Enable()
+			self.btn_gettrips.Enable()
+
+	def PullOrders(self, evt):
 		datasource = self.cb_datasource.GetString(self.cb_datasource.GetSelection())
 
 		try:
-			if datasource == 'Local DB':
-				self.orders = evetrade.readordersfromDB()
-			elif datasource == 'CREST':
-				self.orders = evetrade.getorderdata(API='CREST')
-			elif datasource == 'ESI':
-				self.orders = evetrade.getorderdata(API='ESI')
-		
-		except:
-			pass
-		
-		else:
-			if not self.btn_gettrips.IsEnabled(): self.btn_gettrips.Enable()
-			if not self.btn_saveorders.IsEnabled(): self.btn_saveorders.Enable()
+			minordervalue = int(self.text_minordervalue.GetValue().replace(',',''))
+		except ValueError:
+			self.text_jobstatus.SetLabel('Min. order value must be a whole number')
+			return
 
-		finally:
-			del waitcursor
+		rowfilter = evetrade.makefilter(
+			orderfilter.OrderFilter(minvalue=(minordervalue or None), locationtype=('station' if self.chk_stationsonly.GetValue() else None)),
+			ignore_contraband=self.chk_ignorecontraband.GetValue())
 
-	def SaveOrders(self, evt):
-		waitcursor = wx.BusyCursor()
+		def pull(job):
+			if datasource == 'Local DB': return evetrade.loadorders(rowfilter=rowfilter, progress=job.progress)
+			return evetrade.getorderdata(False, API=datasource, rowfilter=rowfilter, progress=job.progress)
 
-		evetrade.writeorderstoDB(self.orders)
+		def pulled(orders):
+			self.orders = orders
+			self.text_jobstatus.SetLabel('Got {:,} orders'.format(len(orders)))
 
-		del waitcursor
+		self.StartJob(pull, pulled, 'Getting order data...')
 
-	def GetTrips(self, evt):
-		# waitcursor = wx.BusyCursor()
+	def SaveOrders(self, evt):
+		orders = self.orders
 
-		# maxvol = float(self.text_maxvol.GetValue().replace(',',''))
-		# minprofitpertrip = float(self.text_minprofitpertrip.GetValue().replace(',',''))
-		
-		# try:
-		# 	trips = evetrade.findtrips(evetrade.findtrades(self.orders),
-		# 								maxvol=maxvol,
-		# 								minprofitpertrip=minprofitpertrip,
-		# 								minprofitpertrade=900e3,
-		# 								minprofitperjump=900e3,
-		# 								highseconly=self.chk_highseconly.IsChecked())
+		def save(job):
+			return evetrade.writeorderstoDB(orders, progress=job.progress)
 
-		# finally:
-		# 	del waitcursor
+		def saved(counts):
+			self.text_jobstatus.SetLabel('Saved: {:,} new, {:,} changed, {:,} removed'.format(*counts))
 
-		import pickle
-		# with open('trips_temp.pkl', 'wb') as outfile: pickle.dump(trips, outfile)
-		with open('trips_temp.pkl', 'rb') as infile: trips = pickle.load(infile)
+		self.StartJob(save, saved, 'Saving orders...')
 
-		self.tripgrid.SetData(
-			tuple((ii, trip.startsystem, trip.endsystem, trip.totalvol(), trip.profit(), trip.profitperjump(self.chk_highseconly.IsChecked())) for ii, trip in enumerate(trips)))
+	def GetTrips(self, evt):
+		maxvol = float(self.text_maxvol.GetValue().replace(',',''))
+		minprofitpertrip = float(self.text_minprofitpertrip.GetValue().replace(',',''))
+		highseconly = self.chk_highseconly.IsChecked()
+		orders = self.orders
 
 		self.tripgrid.SetColNames(('ID', 'Start', 'End', 'Total volume (m3)', 'Profit (ISK)', 'PPJ (ISK)'))
 		self.tripgrid.SetColFormats((None, None, None, '{:,.2f}', '{:,.2f}', '{:,.2f}'))
-
+		self.tripgrid.SetData(())
 		self.tripgrid.UpdateGrid()
 
-		self.SetSize(self.GetBestSize()[0]*1.1, self.GetBestSize()[1])
+		def find(job):
+			# trips go to the grid in batches as they're found, rows are built here so jump lookups stay off the wx thread
+			batch, ntrips, lastpost = [], 0, time.time()
+
+			def ontrip(trip):
+				nonlocal ntrips, lastpost
+				batch.append((ntrips, trip.startsystem, trip.endsystem, trip.totalvol(), trip.profit(), trip.profitperjump(highseconly)))
+				ntrips += 1
+				if time.time() - lastpost >= job.interval:
+					job.post(TripsFoundEvent(job=job, rows=tuple(batch)))
+					batch.clear()
+					lastpost = time.time()
+
+			trades = evetrade.findtrades(orders, progress=job.progress)
+			trips = evetrade.findtrips(trades, maxvol=maxvol, minprofitpertrip=minprofitpertrip, minprofitpertrade=900e3, minprofitperjump=900e3,
+										highseconly=highseconly, progress=job.progress, ontrip=ontrip)
+
+			if batch: job.post(TripsFoundEvent(job=job, rows=tuple(batch)))
+
+			return trips
+
+		def found(trips):
+			self.text_jobstatus.SetLabel('Found {:,} trips'.format(len(trips)))
+			self.tripgrid.SizeColumns()
+			self.SetSize(self.GetBestSize()[0]*1.1, self.GetBestSize()[1])
+
+		self.StartJob(find, found, 'Finding trips...')
+
+	def OnTripsFound(self, evt):
+		if evt.job is not self.job: return
+		self.tripgrid.AppendData(evt.rows)
 
 	def MakeItemPanel(self):
 		itempanel = wx.Panel(self)
@@ -213,61 +373,121 @@ class MainWindow(wx.Frame):
 		itempanel.SetSizer(vbox1)
 
 
+class DataTable(wx.grid.GridTableBase):
+	# virtual table behind CustomGrid: rows are kept as given and a cell is only formatted when the grid draws it
+	# sorting shuffles a permutation of row indices, the rows themselves are never copied or moved
+
+	def __init__(self):
+		super().__init__()
+		self.data = []
+		self.order = [] # display row -> index into data
+		self.colnames = ()
+		self.colformats = None
+		self.sortcol, self.ascending = None, True
+
+		self._shown = (0, 0) # (rows, cols) the grid was last told about
+
+	def GetNumberRows(self):
+		return len(self.order)
+
+	def GetNumberCols(self):
+		return len(self.colnames)
+
+	def IsEmptyCell(self, row, col):
+		return False
+
+	def GetValue(self, row, col):
+		value = self.data[self.order[row]][col]
+		if self.colformats and self.colformats[col]: return self.colformats[col].format(value)
+		return str(value)
+
+	def SetValue(self, row, col, value):
+		pass # read only
+
+	def GetColLabelValue(self, col):
+		return self.colnames[col]
+
+	def GetRow(self, row):
+		return self.data[self.order[row]]
+
+	def SetData(self, data):
+		self.data = list(data)
+		self.order = list(range(len(self.data)))
+		self.sortcol, self.ascending = None, True
+
+	def AppendData(self, rows):
+		start = len(self.data)
+		self.data.extend(rows)
+		self.order.extend(range(start, len(self.data)))
+		if self.sortcol is not None: self.Sort(self.sortcol, self.ascending) # mostly sorted already, so this is cheap
+
+	def Sort(self, col, ascending):
+		self.sortcol, self.ascending = col, ascending
+		self.order.sort(key=lambda ii: self.data[ii][col], reverse=(not ascending))
+
+	def Notify(self):
+		# tell the view how many rows/cols there are now and have it redraw what's visible
+		view = self.GetView()
+		if view is None: return
+
+		for now, shown, appended, deleted in ((self.GetNumberRows(), self._shown[0], wx.grid.GRIDTABLE_NOTIFY_ROWS_APPENDED, wx.grid.GRIDTABLE_NOTIFY_ROWS_DELETED),
+												(self.GetNumberCols(), self._shown[1], wx.grid.GRIDTABLE_NOTIFY_COLS_APPENDED, wx.grid.GRIDTABLE_NOTIFY_COLS_DELETED)):
+			if now > shown:
+				view.ProcessTableMessage(wx.grid.GridTableMessage(self, appended, now - shown))
+			elif now < shown:
+				view.ProcessTableMessage(wx.grid.GridTableMessage(self, deleted, now, shown - now))
+
+		self._shown = (self.GetNumberRows(), self.GetNumberCols())
+		view.ProcessTableMessage(wx.grid.GridTableMessage(self, wx.grid.GRIDTABLE_REQUEST_VIEW_GET_VALUES))
+
 class CustomGrid(wx.grid.Grid):
+	SIZE_SAMPLE_ROWS = 200 # rows measured when sizing columns
+
 	def __init__(self,*args,**kwargs):
-		self._data = None
-		self._gridcreated = False
 		wx.grid.Grid.__init__(self,*args,**kwargs)
 
+		self._table = DataTable() # we keep the reference, the grid doesn't own it
+		self.SetTable(self._table, takeOwnership=False)
+		self.SetDefaultCellAlignment(wx.ALIGN_RIGHT, wx.ALIGN_CENTRE)
+
 		self.Bind(wx.grid.EVT_GRID_LABEL_LEFT_CLICK, self.OnLabelLeftClicked)
 		self.Bind(wx.grid.EVT_GRID_CELL_LEFT_CLICK, self.OnCellLeftClicked)
 
-	def CreateGrid(self,*args,**kwargs):
-		wx.grid.Grid.CreateGrid(self,*args,**kwargs)
-		self._gridcreated = True
-
-	def WipeGrid(self):
-		self.ClearGrid()
-		if self.GetNumberRows(): self.DeleteRows(pos=0, numRows=self.GetNumberRows())
-		if self.GetNumberCols(): self.DeleteCols(pos=0, numCols=self.GetNumberCols())
-
 	def SetColNames(self, colnames):
-		self._colnames = colnames
+		self._table.colnames = tuple(colnames)
 
 	def SetColFormats(self, colformats):
-		self._colformats = colformats
-
-	def UpdateColNames(self):
-		if self._colnames:
-			for cc in range(0, self.GetNumberCols()):
-				self.SetColLabelValue(cc, self._colnames[cc])
-				self.AutoSizeColLabelSize(cc)
+		self._table.colformats = colformats
 
 	def SetData(self, data):
-		self._data = data
+		self._table.SetData(data)
 
 	def GetData(self, row=None, col=None):
-		if row and col:
-			return self._data[rr][cc]
+		if row is not None and col is not None:
+			return self._table.GetRow(row)[col]
 		else:
-			return self._data
+			return [self._table.GetRow(rr) for rr in range(self._table.GetNumberRows())]
 
 	def UpdateGrid(self):
-		if not self._gridcreated: self.CreateGrid(0,0)
-		self.WipeGrid()
-		self.InsertCols(pos=0, numCols=len(self._data[0]))
-		self.UpdateColNames()
-		self.InsertRows(pos=0, numRows=len(self._data))
-
-		for rr in range(0,self.GetNumberRows()):
-			for cc in range(0,self.GetNumberCols()):
-				if self._colformats and self._colformats[cc]:
-					self.SetCellValue(rr, cc, self._colformats[cc].format(self._data[rr][cc]))
-				else:
-					self.SetCellValue(rr, cc, str(self._data[rr][cc]))
-
-		self.SetDefaultCellAlignment(wx.ALIGN_RIGHT, wx.ALIGN_CENTRE)
-		self.AutoSizeColumns()
+		self._table.Notify()
+		if self.GetSortingColumn() != wx.NOT_FOUND and self._table.sortcol is None: self.UnsetSortingColumn()
+		self.SizeColumns()
+
+	def AppendData(self, rows):
+		# new rows go in without touching the rest (in sort order, if the grid is sorted)
+		self._table.AppendData(rows)
+		self._table.Notify()
+
+	def SizeColumns(self):
+		# AutoSizeColumns would format every cell to measure it, a sample of rows is plenty
+		nrows = min(self._table.GetNumberRows(), self.SIZE_SAMPLE_ROWS)
+		celldc, labeldc = wx.ClientDC(self), wx.ClientDC(self)
+		celldc.SetFont(self.GetDefaultCellFont())
+		labeldc.SetFont(self.GetLabelFont())
+
+		for cc in range(self._table.GetNumberCols()):
+			width = max([labeldc.GetTextExtent(self._table.GetColLabelValue(cc))[0]] + [celldc.GetTextExtent(self._table.GetValue(rr, cc))[0] for rr in range(nrows)])
+			self.SetColSize(cc, width + 16)
 
 	def SortGrid(self, sortcol):
 		if self.GetSortingColumn() == sortcol and self.IsSortOrderAscending():
@@ -275,9 +495,9 @@ class CustomGrid(wx.grid.Grid):
 		else:
 			ascending = True
 
-		self._data = sorted(self._data, key=itemgetter(sortcol), reverse=(not ascending))
+		self._table.Sort(sortcol, ascending)
 		self.SetSortingColumn(sortcol, ascending=ascending)
-		self.UpdateGrid()
+		self.ForceRefresh()
 
 	def OnLabelLeftClicked(self, evt):
 		row, col = evt.GetRow(), evt.GetCol()
@@ -291,7 +511,7 @@ class CustomGrid(wx.grid.Grid):
 		self.SelectTrip(row)
 
 	def SelectTrip(self, row):
-		print(self._data[row])
+		print(self._table.GetRow(row))
 	
 
 if __name__ == '__main__':
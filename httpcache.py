@@ -0,0 +1,145 @@
+## On-disk cache for GET responses, keyed by URL + params
+## Fresh entries (before their Expires time) are served without touching the network, stale ones are revalidated with
+## If-None-Match so unchanged pages come back as a body-less 304. Size-bounded, least recently used entries go first.
+
+import json
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import sqlitetools
+
+MAX_BYTES = 512 * 1024**2
+
+KEEP_HEADERS = ('Content-Type', 'ETag', 'Expires', 'Last-Modified', 'X-Pages') # headers worth replaying from cache
+
+def cachekey(url, params=None):
+	params = sorted((k, str(v)) for k, v in (params or {}).items() if v is not None) # requests drops None params too
+	return url + '?' + '&'.join('{}={}'.format(k, v) for k, v in params)
+
+def parseexpires(headers):
+	# returns expiry as a unix timestamp, or None
+	try:
+		return parsedate_to_datetime(headers['Expires']).timestamp()
+	except (KeyError, TypeError, ValueError):
+		return None
+
+def makeresponse(url, status_code, headers, body):
+	resp = requests.Response()
+	resp.url = url
+	resp.status_code = status_code
+	resp.headers = CaseInsensitiveDict(headers)
+	resp._content = body
+	resp.encoding = 'utf-8'
+	return resp
+
+class HTTPCache:
+
+	def __init__(self, db, maxbytes=MAX_BYTES):
+		self.db = db
+		self.maxbytes = maxbytes
+
+		self._lock = threading.Lock()
+		self._conn = sqlitetools.connect(db, check_same_thread=False)
+		self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, etag TEXT, expires REAL, headers TEXT, body BLOB, size INT, lastused REAL)''')
+		self._conn.execute('''CREATE INDEX IF NOT EXISTS responses_lastused ON responses (lastused)''')
+		self._conn.commit()
+
+		self._size = self._conn.execute('''SELECT COALESCE(SUM(size), 0) FROM responses''').fetchone()[0]
+		self._stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'bytes_saved': 0}
+
+	def stats(self):
+		with self._lock:
+			return dict(self._stats, entries=self._conn.execute('''SELECT COUNT(*) FROM responses''').fetchone()[0], size=self._size)
+
+	def _lookup(self, key):
+		with self._lock:
+			return self._conn.execute('''SELECT url,etag,expires,headers,body FROM responses WHERE key=?''', (key,)).fetchone()
+
+	def _touch(self, key, expires=None, headers=None):
+		with self._lock, self._conn:
+			if headers is None:
+				self._conn.execute('''UPDATE responses SET lastused=? WHERE key=?''', (time.time(), key))
+			else:
+				self._conn.execute('''UPDATE responses SET lastused=?, expires=?, headers=? WHERE key=?''', (time.time(), expires, json.dumps(headers), key))
+
+	def _store(self, key, url, resp):
+		headers = {k: resp.headers[k] for k in KEEP_HEADERS if k in resp.headers}
+		etag, expires = resp.headers.get('ETag'), parseexpires(resp.headers)
+		if etag is None and expires is None: return # nothing to gain from keeping it
+
+		body = resp.content
+		if len(body) > self.maxbytes: return
+
+		with self._lock, self._conn:
+			old = self._conn.execute('''SELECT size FROM responses WHERE key=?''', (key,)).fetchone()
+			if old: self._size -= old[0]
+
+			self._conn.execute('''INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?)''', (key, url, etag, expires, json.dumps(headers), body, len(body), time.time()))
+			self._size += len(body)
+			self._stats['stored'] += 1
+
+			self._evict()
+
+	def _evict(self):
+		# drop least recently used entries until we're back under the limit, caller holds the lock
+		while self._size > self.maxbytes:
+			victims = self._conn.execute('''SELECT key,size FROM responses ORDER BY lastused LIMIT 100''').fetchall()
+			if not victims: break
+
+			for key, size in victims:
+				if self._size <= self.maxbytes: break
+				self._conn.execute('''DELETE FROM responses WHERE key=?''', (key,))
+				self._size -= size
+				self._stats['evicted'] += 1
+
+	def get(self, url, params=None, timeout=10, session=None):
+		# drop-in for session.get / requests.get
+		key = cachekey(url, params)
+		cached = self._lookup(key)
+
+		if cached:
+			cachedurl, etag, expires, headers, body = cached
+			headers = json.loads(headers)
+
+			if expires is not None and expires > time.time():
+				self._touch(key)
+				with self._lock:
+					self._stats['hits'] += 1
+					self._stats['bytes_saved'] += len(body)
+				return makeresponse(cachedurl, requests.codes.ok, headers, body)
+
+			reqheaders = ({'If-None-Match': etag} if etag else None)
+		else:
+			reqheaders = None
+
+		getter = (session.get if session is not None else requests.get)
+		resp = getter(url, params=params, timeout=timeout, headers=reqheaders)
+
+		if cached and resp.status_code == requests.codes.not_modified:
+			# unchanged: keep the body we have, pick up the new expiry
+			headers.update({k: resp.headers[k] for k in KEEP_HEADERS if k in resp.headers})
+			self._touch(key, parseexpires(resp.headers), headers)
+			with self._lock:
+				self._stats['revalidated'] += 1
+				self._stats['bytes_saved'] += len(body)
+			return makeresponse(cachedurl, requests.codes.ok, headers, body)
+
+		with self._lock:
+			self._stats['misses'] += 1
+
+		if resp.status_code == requests.codes.ok: self._store(key, url, resp)
+
+		return resp
+
+	def clear(self):
+		with self._lock, self._conn:
+			self._conn.execute('''DELETE FROM responses''')
+			self._size = 0
+
+	def close(self):
+		with self._lock:
+			self._conn.close()
@@ -0,0 +1,151 @@
+## Local stargate graph with precomputed all-pairs jump counts, so route lengths don't need a trip to dotlan
+## Stargate data comes from the static data export (e.g. https://www.fuzzwork.co.uk/dump/latest/ mapSolarSystemJumps.csv, mapSolarSystems.csv)
+
+import csv
+import sqlite3
+import time
+from array import array
+from collections import deque
+
+import sqlitetools
+
+UNREACHABLE = 255 # jump counts are stored as single bytes
+HIGHSEC = 0.45 # security rounds up to 0.5 from here
+
+def loadstargates(db, jumpsfile, systemsfile):
+	# read stargate connections and system info from static data CSVs into the aux DB
+	with open(jumpsfile, newline='') as infile:
+		gates = set()
+		for row in csv.DictReader(infile):
+			system1, system2 = int(row['fromSolarSystemID']), int(row['toSolarSystemID'])
+			gates.add((min(system1, system2), max(system1, system2)))
+
+	with open(systemsfile, newline='') as infile:
+		systems = [(int(row['solarSystemID']), row['solarSystemName'], float(row['security'])) for row in csv.DictReader(infile)]
+
+	with sqlitetools.connect(db) as conn:
+		conn.execute('''DROP TABLE IF EXISTS stargates''')
+		conn.execute('''CREATE TABLE stargates (system1 INT, system2 INT)''')
+		conn.executemany('''INSERT INTO stargates VALUES (?,?)''', sorted(gates))
+		conn.executemany('''INSERT OR REPLACE INTO systems VALUES (?,?,?)''', systems)
+
+	conn.close()
+
+	return len(gates), len(systems)
+
+class JumpGraph:
+
+	def __init__(self, systems, matrices):
+		# systems: systemIDs in matrix order
+		# matrices: {highseconly: upper triangle of the jump count matrix, row by row, as bytes}
+		self.systems = tuple(systems)
+		self.index = {ss: ii for ii, ss in enumerate(self.systems)}
+		self.matrices = matrices
+
+		self._n = len(self.systems)
+
+	def _pos(self, ii, jj):
+		# position of (ii, jj), ii < jj, in the flattened upper triangle
+		return ii*self._n - ii*(ii+1)//2 + (jj - ii - 1)
+
+	def jumps(self, system1, system2, highseconly):
+		# returns no. of jumps, or None if there's no route / we don't know the systems
+		if system1 == system2: return 0
+
+		try:
+			ii, jj = self.index[system1], self.index[system2]
+		except KeyError:
+			return None
+
+		if ii > jj: ii, jj = jj, ii
+
+		jumps = self.matrices[highseconly][self._pos(ii, jj)]
+
+		return (None if jumps == UNREACHABLE else jumps)
+
+	@classmethod
+	def build(cls, gates, security):
+		# gates: iterable of (system1, system2)
+		# security: {systemID: security status}
+		# highsec-only routes may start and end anywhere but only pass through highsec systems in between
+		gates = list(gates)
+		systems = sorted(set(ii for gate in gates for ii in gate))
+		index = {ss: ii for ii, ss in enumerate(systems)}
+		n = len(systems)
+
+		adjacency = [[] for ii in range(n)]
+		for system1, system2 in gates:
+			adjacency[index[system1]].append(index[system2])
+			adjacency[index[system2]].append(index[system1])
+
+		ishighsec = [security.get(ss, -1) >= HIGHSEC for ss in systems]
+		passable = {False: [True]*n, True: ishighsec}
+
+		matrices = {}
+		for highseconly in (False, True):
+			canpass = passable[highseconly]
+			matrix = bytearray([UNREACHABLE]) * (n*(n-1)//2)
+
+			for source in range(n):
+				dist = bytearray([UNREACHABLE]) * n
+				dist[source] = 0
+				queue = deque((source,))
+
+				while queue:
+					node = queue.popleft()
+					if node != source and not canpass[node]: continue
+
+					nextdist = min(dist[node] + 1, UNREACHABLE - 1)
+					for neighbour in adjacency[node]:
+						if dist[neighbour] == UNREACHABLE:
+							dist[neighbour] = nextdist
+							queue.append(neighbour)
+
+				# keep only the part of this row above the diagonal
+				start = source*n - source*(source+1)//2
+				matrix[start:start + n - source - 1] = dist[source+1:]
+
+			matrices[highseconly] = bytes(matrix)
+
+		return cls(systems, matrices)
+
+	@classmethod
+	def fromDB(cls, db):
+		# returns None if no precomputed matrices have been stored
+		with sqlitetools.connect(db) as conn:
+			try:
+				rows = conn.execute('''SELECT highsecOnly,systems,matrix FROM jumpmatrix''').fetchall()
+			except sqlite3.OperationalError:
+				rows = []
+		conn.close()
+
+		if len(rows) < 2: return None
+
+		systems = array('q')
+		systems.frombytes(rows[0][1])
+
+		return cls(systems, {bool(ii[0]): ii[2] for ii in rows})
+
+	def toDB(self, db):
+		systems = array('q', self.systems).tobytes()
+
+		with sqlitetools.connect(db) as conn:
+			conn.execute('''DROP TABLE IF EXISTS jumpmatrix''')
+			conn.execute('''CREATE TABLE jumpmatrix (highsecOnly BOOL PRIMARY KEY, systems BLOB, matrix BLOB)''')
+			conn.executemany('''INSERT INTO jumpmatrix VALUES (?,?,?)''', ((highseconly, systems, matrix) for highseconly, matrix in self.matrices.items()))
+
+		conn.close()
+
+def buildfromDB(db):
+	# precompute jump matrices from the stargates/systems tables and store them alongside
+	t1 = time.time()
+
+	with sqlitetools.connect(db) as conn:
+		gates = conn.execute('''SELECT system1,system2 FROM stargates''').fetchall()
+		security = dict(conn.execute('''SELECT systemID,security FROM systems''').fetchall())
+	conn.close()
+
+	graph = JumpGraph.build(gates, security)
+	graph.toDB(db)
+
+	return graph, time.time() - t1
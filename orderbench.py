@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+## Memory benchmark: bytes per order for plain objects, __slots__ Orders and an array-backed OrderBook
+
+import sys
+import random
+import tracemalloc
+
+import evetrade
+import orderbook
+
+class DictOrder:
+	# what Order looked like before __slots__
+
+	def __init__(self, orderID, itemID, orderType, price, orderQty, locationID, systemID=None):
+		self.orderID = orderID
+		self.itemID = itemID
+		self.orderType = orderType
+		self.price = price
+		self.orderQty = orderQty
+		self.locationID = locationID
+		self.systemID = systemID
+
+def randomrows(n):
+	random.seed(0)
+	return [(4800000000 + ii, random.randrange(18, 40000), 60000000 + random.randrange(5000), random.choice(('buy', 'sell')), round(random.uniform(1, 1e9), 2), random.randrange(1, 1000000), 30000000 + random.randrange(5000)) for ii in range(n)]
+
+def measure(build, n):
+	# rows are made inside the trace and thrown away afterwards, so whatever the orders keep hold of (ints, floats...) is counted
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	rows = randomrows(n)
+	orders = build(rows)
+	del rows
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	return (after - before) / n, orders
+
+if __name__ == '__main__':
+	n = (int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+
+	builders = (
+		('dict-backed Order', lambda rows: [DictOrder(orderID=ii[0], itemID=ii[1], locationID=ii[2], orderType=ii[3], price=ii[4], orderQty=ii[5], systemID=ii[6]) for ii in rows]),
+		('__slots__ Order', lambda rows: [evetrade.Order(orderID=ii[0], itemID=ii[1], locationID=ii[2], orderType=ii[3], price=ii[4], orderQty=ii[5], systemID=ii[6]) for ii in rows]),
+		('OrderBook', orderbook.OrderBook.fromrows),
+		)
+
+	print('{:,} orders'.format(n))
+	for name, build in builders:
+		bytesperorder, orders = measure(build, n)
+		print('{:<20} {:>8.1f} bytes/order'.format(name, bytesperorder))
+		del orders
@@ -0,0 +1,127 @@
+## Compact order storage: one typed array per field instead of one Python object per order
+## OrderBook hands out OrderViews, which look just like evetrade.Order but only hold (book, index)
+
+from array import array
+
+# field: array typecode
+COLUMNS = (
+	('orderID', 'q'),
+	('itemID', 'q'),
+	('locationID', 'q'),
+	('isbuy', 'b'),
+	('price', 'd'),
+	('orderQty', 'q'),
+	('systemID', 'q'), # 0 = unknown
+	)
+
+def _column(name):
+	def getter(self): return getattr(self._book, name)[self._idx]
+	def setter(self, value): getattr(self._book, name)[self._idx] = value
+	return property(getter, setter)
+
+class OrderView:
+	__slots__ = ('_book', '_idx')
+
+	def __init__(self, book, idx):
+		self._book = book
+		self._idx = idx
+
+	orderID = _column('orderID')
+	itemID = _column('itemID')
+	locationID = _column('locationID')
+	price = _column('price')
+	orderQty = _column('orderQty')
+
+	@property
+	def orderType(self):
+		return ('buy' if self._book.isbuy[self._idx] else 'sell')
+
+	@orderType.setter
+	def orderType(self, value):
+		self._book.isbuy[self._idx] = (value == 'buy')
+
+	@property
+	def systemID(self):
+		return (self._book.systemID[self._idx] or None)
+
+	@systemID.setter
+	def systemID(self, value):
+		self._book.systemID[self._idx] = (value or 0)
+
+	def __eq__(self, other):
+		return isinstance(other, OrderView) and self._book is other._book and self._idx == other._idx
+
+	def __hash__(self):
+		return hash((id(self._book), self._idx))
+
+	def __repr__(self):
+		return 'OrderView({}, {}, {}, {}, {}, {}, {})'.format(self.orderID, self.itemID, self.orderType, self.price, self.orderQty, self.locationID, self.systemID)
+
+class OrderBook:
+
+	def __init__(self):
+		for name, typecode in COLUMNS: setattr(self, name, array(typecode))
+
+	def __len__(self):
+		return len(self.orderID)
+
+	def __getitem__(self, idx):
+		if isinstance(idx, slice): return [OrderView(self, ii) for ii in range(*idx.indices(len(self)))]
+
+		if idx < 0: idx += len(self)
+		if not 0 <= idx < len(self): raise IndexError('OrderBook index out of range')
+
+		return OrderView(self, idx)
+
+	def __iter__(self):
+		return (OrderView(self, ii) for ii in range(len(self)))
+
+	def append(self, orderID, itemID, locationID, orderType, price, orderQty, systemID=None):
+		# same field order as the orders table
+		self.orderID.append(orderID)
+		self.itemID.append(itemID)
+		self.locationID.append(locationID)
+		self.isbuy.append(orderType == 'buy')
+		self.price.append(price)
+		self.orderQty.append(orderQty)
+		self.systemID.append(systemID or 0)
+
+	def extend(self, rows):
+		# rows: (orderID, itemID, locationID, orderType, price, orderQty[, systemID])
+		for row in rows: self.append(*row)
+
+	def extendbook(self, other):
+		# append all of another book's orders, column by column
+		for name, typecode in COLUMNS: getattr(self, name).extend(getattr(other, name))
+
+	def rows(self):
+		# (orderID, itemID, locationID, orderType, price, orderQty, systemID) per order, straight off the columns
+		return zip(self.orderID, self.itemID, self.locationID, (('buy' if ii else 'sell') for ii in self.isbuy), self.price, self.orderQty, ((ii or None) for ii in self.systemID))
+
+	def filter(self, keep):
+		# new book with only the orders where keep(order) is true
+		book = OrderBook()
+		for oo in self:
+			if keep(oo): book.append(oo.orderID, oo.itemID, oo.locationID, oo.orderType, oo.price, oo.orderQty, oo.systemID)
+		return book
+
+	def nbytes(self):
+		return sum(len(getattr(self, name)) * getattr(self, name).itemsize for name, typecode in COLUMNS)
+
+	@classmethod
+	def fromrows(cls, rows):
+		book = cls()
+		book.extend(rows)
+		return book
+
+	@classmethod
+	def fromcolumns(cls, columns):
+		# book over existing column buffers ({field: array or memoryview}), no copying
+		# read-only if the buffers are, e.g. a mapped snapshot file
+		book = cls.__new__(cls)
+		for name, typecode in COLUMNS: setattr(book, name, columns[name])
+		return book
+
+	@classmethod
+	def fromorders(cls, orders):
+		return cls.fromrows((oo.orderID, oo.itemID, oo.locationID, oo.orderType, oo.price, oo.orderQty, oo.systemID) for oo in orders)
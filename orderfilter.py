@@ -0,0 +1,130 @@
+## Declarative filters for market orders, applied while ingesting (to raw rows, before any Order exists)
+## or pushed down into SQL when reading from the order DB
+
+import json
+
+import numpy as np
+
+STRUCTURE_IDS = (1020000000000, 1029999999999) # see evetrade.isstructureID
+
+class OrderFilter:
+
+	def __init__(self, items_deny=(), items_allow=None, minprice=None, maxprice=None, minvalue=None,
+					regions=None, minsecurity=None, maxsecurity=None, locationtype=None):
+		# items_deny / items_allow: itemIDs to drop / the only itemIDs to keep
+		# minprice, maxprice: unit price bounds (ISK)
+		# minvalue: min. total order value, price x remaining quantity (ISK)
+		# regions: only these regionIDs (only when pulling from the API, the order DB doesn't know regions)
+		# minsecurity, maxsecurity: security band of the order's system
+		# locationtype: 'station', 'structure' or None for both
+		if locationtype not in (None, 'station', 'structure'): raise Exception('locationtype must be "station", "structure" or None')
+
+		self.items_deny = frozenset(int(ii) for ii in items_deny)
+		self.items_allow = (None if items_allow is None else frozenset(int(ii) for ii in items_allow))
+		self.minprice = minprice
+		self.maxprice = maxprice
+		self.minvalue = minvalue
+		self.regions = (None if regions is None else frozenset(regions))
+		self.minsecurity = minsecurity
+		self.maxsecurity = maxsecurity
+		self.locationtype = locationtype
+
+	def __repr__(self):
+		return 'OrderFilter({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in vars(self).items() if v not in (None, frozenset())))
+
+	def withdeny(self, items):
+		# copy of this filter that also drops these items
+		new = OrderFilter.__new__(OrderFilter)
+		new.__dict__.update(self.__dict__)
+		new.items_deny = self.items_deny | frozenset(int(ii) for ii in items)
+		return new
+
+	def keepregion(self, regionID):
+		return self.regions is None or regionID in self.regions
+
+	def needssecurity(self):
+		return self.minsecurity is not None or self.maxsecurity is not None
+
+	def keepsecurity(self, security):
+		if security is None: return not self.needssecurity()
+		if self.minsecurity is not None and security < self.minsecurity: return False
+		if self.maxsecurity is not None and security > self.maxsecurity: return False
+		return True
+
+	def securesystems(self, systemIDs, securityof):
+		# the known systems (> 0) among systemIDs that are inside the security band, sorted
+		# securityof(systemID): system security lookup
+		return sorted(ss for ss in set(systemIDs) if ss and ss > 0 and self.keepsecurity(securityof(ss)))
+
+	def rowpredicate(self):
+		# returns a function taking a trimmed row (orderID, itemID, locationID, orderType, price, orderQty), or None if there's nothing to check
+		# security isn't checked here, it needs the system - see keepsecurity
+		checks = []
+
+		if self.items_deny: checks.append(lambda row, deny=self.items_deny: row[1] not in deny)
+		if self.items_allow is not None: checks.append(lambda row, allow=self.items_allow: row[1] in allow)
+		if self.minprice is not None: checks.append(lambda row, bound=self.minprice: row[4] >= bound)
+		if self.maxprice is not None: checks.append(lambda row, bound=self.maxprice: row[4] <= bound)
+		if self.minvalue is not None: checks.append(lambda row, bound=self.minvalue: row[4] * row[5] >= bound)
+		if self.locationtype is not None:
+			wantstructure = (self.locationtype == 'structure')
+			checks.append(lambda row: (STRUCTURE_IDS[0] <= row[2] <= STRUCTURE_IDS[1]) == wantstructure)
+
+		if not checks: return None
+		if len(checks) == 1: return checks[0]
+
+		return lambda row: all(check(row) for check in checks)
+
+	def columnmask(self, cols, securityof=None):
+		# rowpredicate and keepsecurity at once over a columnar.OrderColumns, returns a boolean mask of orders to keep
+		# securityof(systemID): system security lookup, only needed for a security band
+		mask = np.ones(len(cols), dtype=np.bool_)
+
+		if self.items_deny: mask &= ~np.isin(cols.itemID, np.fromiter(self.items_deny, dtype=np.int64))
+		if self.items_allow is not None: mask &= np.isin(cols.itemID, np.fromiter(self.items_allow, dtype=np.int64))
+		if self.minprice is not None: mask &= (cols.price >= self.minprice)
+		if self.maxprice is not None: mask &= (cols.price <= self.maxprice)
+		if self.minvalue is not None: mask &= (cols.price * cols.qty >= self.minvalue)
+		if self.locationtype is not None:
+			isstructure = (cols.locationID >= STRUCTURE_IDS[0]) & (cols.locationID <= STRUCTURE_IDS[1])
+			mask &= (isstructure if self.locationtype == 'structure' else ~isstructure)
+		if self.needssecurity():
+			secure = self.securesystems(np.unique(cols.systemID[mask]).tolist(), securityof)
+			mask &= np.isin(cols.systemID, np.array(secure, dtype=np.int64))
+
+		return mask
+
+	def sqlwhere(self, alias=None, systems=None):
+		# returns (WHERE clause or '', params) for the orders table
+		# item lists are bound as one JSON array each, so they can be any length
+		# alias: the orders table's alias in the query, if it's joined to anything
+		# systems: for a security band, the systems inside it (see securesystems) - worked out by the caller in Python, as at
+		# ingest, so systems the aux DB hasn't seen yet get looked up rather than dropped
+		if self.needssecurity() and systems is None: raise Exception('Need the systems inside the security band, see securesystems')
+
+		clauses, params = [], []
+		col = (lambda name: name) if alias is None else (lambda name: '{}.{}'.format(alias, name))
+
+		if self.items_deny:
+			clauses.append('{} NOT IN (SELECT value FROM json_each(?))'.format(col('itemID')))
+			params.append(json.dumps(sorted(self.items_deny)))
+		if self.items_allow is not None:
+			clauses.append('{} IN (SELECT value FROM json_each(?))'.format(col('itemID')))
+			params.append(json.dumps(sorted(self.items_allow)))
+		if self.minprice is not None:
+			clauses.append(col('price') + ' >= ?')
+			params.append(self.minprice)
+		if self.maxprice is not None:
+			clauses.append(col('price') + ' <= ?')
+			params.append(self.maxprice)
+		if self.minvalue is not None:
+			clauses.append('{} * {} >= ?'.format(col('price'), col('orderQty')))
+			params.append(self.minvalue)
+		if self.locationtype is not None:
+			clauses.append('{} {}BETWEEN ? AND ?'.format(col('locationID'), '' if self.locationtype == 'structure' else 'NOT '))
+			params.extend(STRUCTURE_IDS)
+		if self.needssecurity():
+			clauses.append('{} IN (SELECT value FROM json_each(?))'.format(col('systemID')))
+			params.append(json.dumps(list(systems)))
+
+		return (('WHERE ' + ' AND '.join(clauses)) if clauses else ''), params
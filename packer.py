@@ -0,0 +1,123 @@
+## Trip packing: how many units of each trade to haul, given a cargo volume limit and optionally an ISK budget
+## Bounded knapsack solved by DP over a discretised volume (and capital) grid, falls back to greedy if it runs out of time
+
+import time
+import math
+
+import numpy as np
+
+VOLUME_CELLS = 1024 # min. grid resolution for volume
+CAPITAL_CELLS = 64 # min. grid resolution per axis when there's a capital budget too
+GRID_BUDGET = 2**18 # cell updates per route, small routes get a finer grid (less slack from rounding sizes up) for the same work
+MAX_VOLUME_CELLS = 2**16
+MAX_CAPITAL_CELLS = 512
+MAX_DP_TRADES = 64 # only the densest trades go into the DP, the rest can still fill leftover space
+TIME_BUDGET = 0.05 # sec per route before giving up on the DP
+
+def greedy(unitvol, unitprofit, maxqty, maxvol, unitcost=None, capital=None, qty=None):
+	# take trades in the order given (best first), as many units as fit
+	# qty: units already taken, topped up in place if given
+	if qty is None: qty = np.zeros(len(unitvol), dtype=np.int64)
+
+	vol_remaining = maxvol - float(np.dot(qty, unitvol))
+	cap_remaining = (None if capital is None else capital - float(np.dot(qty, unitcost)))
+
+	for ii in range(len(unitvol)):
+		if vol_remaining <= 0: break
+
+		room = maxqty[ii] - qty[ii]
+		if room <= 0: continue
+
+		if unitvol[ii] > 0: room = min(room, int(vol_remaining / unitvol[ii]))
+		if cap_remaining is not None and unitcost[ii] > 0: room = min(room, int(cap_remaining / unitcost[ii]))
+		if room <= 0: continue
+
+		qty[ii] += room
+		vol_remaining -= room * unitvol[ii]
+		if cap_remaining is not None: cap_remaining -= room * unitcost[ii]
+
+	return qty
+
+def _chunks(maxqty):
+	# binary split of a quantity: 1, 2, 4, ..., remainder - any amount up to maxqty is a sum of some of these
+	chunks, kk = [], 1
+	while maxqty > 0:
+		chunk = min(kk, maxqty)
+		chunks.append(chunk)
+		maxqty -= chunk
+		kk *= 2
+	return chunks
+
+def _cells(size, quantum):
+	# grid cells needed for size, rounded up (a float hair over a whole number doesn't count)
+	return math.ceil(size / quantum - 1e-9)
+
+def knapsack(unitvol, unitprofit, maxqty, maxvol, unitcost=None, capital=None, deadline=None):
+	# DP over a grid, item sizes are rounded up to whole cells so whatever it picks really fits (at the cost of some slack)
+	# returns units per trade, or None if we ran past the deadline
+	nchunks = max(sum(len(_chunks(int(qq))) for qq in maxqty), 1)
+	if capital is None:
+		cells = min(max(GRID_BUDGET // nchunks, VOLUME_CELLS), MAX_VOLUME_CELLS)
+		shape = (cells + 1,)
+		volquantum, capquantum = maxvol / cells, None
+	else:
+		cells = min(max(math.isqrt(GRID_BUDGET // nchunks), CAPITAL_CELLS), MAX_CAPITAL_CELLS)
+		shape = (cells + 1, cells + 1)
+		volquantum, capquantum = maxvol / cells, capital / cells
+
+	dp = np.zeros(shape)
+	chosen = [] # (trade, units, cells, taken)
+
+	for ii in range(len(unitvol)):
+		for units in _chunks(int(maxqty[ii])):
+			weight = (_cells(units * unitvol[ii], volquantum),)
+			if capquantum is not None: weight += (_cells(units * unitcost[ii], capquantum),)
+			if any(ww > ss - 1 for ww, ss in zip(weight, shape)): continue
+
+			value = units * unitprofit[ii]
+			dest = tuple(slice(ww, None) for ww in weight)
+			src = tuple(slice(0, ss - ww) for ww, ss in zip(weight, shape))
+
+			candidate = dp[src] + value
+			taken = np.zeros(shape, dtype=np.bool_)
+			taken[dest] = candidate > dp[dest]
+			dp[dest] = np.maximum(dp[dest], candidate)
+
+			chosen.append((ii, units, weight, taken))
+
+			if deadline is not None and time.time() > deadline: return None
+
+	qty = np.zeros(len(unitvol), dtype=np.int64)
+	cell = tuple(ss - 1 for ss in shape)
+	for ii, units, weight, taken in reversed(chosen):
+		if taken[cell]:
+			qty[ii] += units
+			cell = tuple(cc - ww for cc, ww in zip(cell, weight))
+
+	return qty
+
+def pack(unitvol, unitprofit, maxqty, maxvol, unitcost=None, capital=None, timebudget=TIME_BUDGET):
+	# trades should already be sorted best first (profit per m3)
+	# returns units to take of each trade
+	unitvol, unitprofit, maxqty = np.asarray(unitvol, dtype=np.float64), np.asarray(unitprofit, dtype=np.float64), np.asarray(maxqty, dtype=np.int64)
+	if unitcost is not None: unitcost = np.asarray(unitcost, dtype=np.float64)
+	if capital is not None and unitcost is None: raise Exception('Need unit costs to pack against a capital budget')
+
+	best = greedy(unitvol, unitprofit, maxqty, maxvol, unitcost, capital)
+
+	# greedy took everything there is, can't do better (or there's no room for a grid at all)
+	if np.array_equal(best, maxqty) or maxvol <= 0 or (capital is not None and capital <= 0): return best
+
+	deadline = time.time() + timebudget
+	top = slice(0, MAX_DP_TRADES)
+	qty_dp = knapsack(unitvol[top], unitprofit[top], maxqty[top], maxvol, (None if unitcost is None else unitcost[top]), capital, deadline)
+	if qty_dp is None: return best
+
+	# the grid rounds sizes up, so there can be some space left to top up
+	qty = np.zeros(len(unitvol), dtype=np.int64)
+	qty[top] = qty_dp
+	qty = greedy(unitvol, unitprofit, maxqty, maxvol, unitcost, capital, qty=qty)
+
+	if np.dot(qty, unitprofit) > np.dot(best, unitprofit): best = qty
+
+	return best
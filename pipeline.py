@@ -0,0 +1,108 @@
+## Threaded streaming pipeline: each stage runs in its own worker thread(s) and hands items on through a bounded queue,
+## so a slow stage makes the stages before it wait (backpressure) instead of piling everything up in memory
+
+import queue
+import threading
+
+QUEUE_SIZE = 16 # default max. items waiting between two stages
+
+_END = object() # end-of-stream marker
+
+class PipelineAborted(Exception):
+	pass
+
+class Pipeline:
+
+	def __init__(self, source, queuesize=QUEUE_SIZE):
+		# source: any iterable, consumed in its own thread
+		self.source = source
+		self.queuesize = queuesize
+		self.stages = []
+
+		self._abort = threading.Event()
+		self._errors = []
+
+	def addstage(self, func, workers=1, name=None):
+		# func takes one item and returns an iterable of items for the next stage (empty to drop the item)
+		self.stages.append((func, workers, name or func.__name__))
+		return self
+
+	def abort(self):
+		self._abort.set()
+
+	def _put(self, q, item):
+		while not self._abort.is_set():
+			try:
+				q.put(item, timeout=0.1)
+			except queue.Full:
+				continue
+			else:
+				return True
+		return False
+
+	def _get(self, q):
+		while not self._abort.is_set():
+			try:
+				return q.get(timeout=0.1)
+			except queue.Empty:
+				continue
+		return _END
+
+	def _fail(self, name, e):
+		self._errors.append((name, e))
+		self._abort.set()
+
+	def _feed(self, outq, nconsumers):
+		try:
+			for item in self.source:
+				if not self._put(outq, item): return
+		except Exception as e:
+			self._fail('source', e)
+		finally:
+			for ii in range(nconsumers): self._put(outq, _END)
+
+	def _work(self, func, name, inq, outq, state, nconsumers):
+		try:
+			while True:
+				item = self._get(inq)
+				if item is _END: break
+
+				for out in func(item):
+					if not self._put(outq, out): return
+		except Exception as e:
+			self._fail(name, e)
+		finally:
+			# last worker out of this stage passes end-of-stream on to the next one
+			with state['lock']:
+				state['running'] -= 1
+				if state['running'] == 0:
+					for ii in range(nconsumers): self._put(outq, _END)
+
+	def run(self):
+		# generator over the items coming out of the last stage
+		if not self.stages: raise Exception('Pipeline has no stages')
+
+		queues = [queue.Queue(maxsize=self.queuesize) for ii in range(len(self.stages)+1)]
+		threads = [threading.Thread(target=self._feed, args=(queues[0], self.stages[0][1]), daemon=True)]
+
+		for ii, (func, workers, name) in enumerate(self.stages):
+			nconsumers = (self.stages[ii+1][1] if ii+1 < len(self.stages) else 1)
+			state = {'lock': threading.Lock(), 'running': workers}
+			for ww in range(workers):
+				threads.append(threading.Thread(target=self._work, args=(func, name, queues[ii], queues[ii+1], state, nconsumers), name='{}-{}'.format(name, ww), daemon=True))
+
+		for tt in threads: tt.start()
+
+		try:
+			while True:
+				item = self._get(queues[-1])
+				if item is _END: break
+				yield item
+		finally:
+			# all done, or the consumer stopped early, or something broke - wind everything down
+			self._abort.set()
+			for tt in threads: tt.join()
+
+		if self._errors:
+			name, e = self._errors[0]
+			raise PipelineAborted('Stage "{}" failed: {}'.format(name, e)) from e
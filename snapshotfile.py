@@ -0,0 +1,150 @@
+## Binary columnar snapshot of an OrderBook: a small header, then one fixed-width array per column
+## Read back through mmap, so every process that opens it shares the OS page cache and nothing is parsed or copied
+## Each write goes to a new versioned file, and path itself is a small pointer file naming the current one, swapped in
+## atomically once the new version is complete - the file a reader has mapped is never written over or renamed onto,
+## which Windows wouldn't allow
+
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+import orderbook
+
+MAGIC = b'EVESNAP\0'
+VERSION = 1
+ALIGN = 64 # column offsets are multiples of this
+REPLACE_RETRIES = 20
+
+HEADER = struct.Struct('<8sHHIqd') # magic, version, little endian?, no. of columns, no. of orders, timestamp
+COLUMN = struct.Struct('<16s2sxxIq') # name, typecode, item size, offset
+
+def _align(offset):
+	return -(-offset // ALIGN) * ALIGN
+
+def _versions(path):
+	# data files written for path, oldest first
+	folder, base = os.path.split(os.path.abspath(path))
+	return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.startswith(base + '.') and not name.endswith('.tmp'))
+
+def _current(path):
+	# the data file path points to; a snapshot written before the pointer file is its own data file
+	with open(path, 'rb') as infile:
+		head = infile.read(len(MAGIC))
+		if head == MAGIC: return path
+		name = (head + infile.read()).decode().strip()
+
+	return os.path.join(os.path.dirname(os.path.abspath(path)), name)
+
+def _replace(src, dst):
+	# os.replace, retried for a moment on Windows while a reader has dst open
+	for attempt in range(REPLACE_RETRIES):
+		try:
+			return os.replace(src, dst)
+		except PermissionError:
+			if attempt == REPLACE_RETRIES - 1: raise
+			time.sleep(0.05)
+
+def write(path, book, timestamp=None, capacity=None):
+	# write a new version of the snapshot and point path at it, readers see either the old one or the new one
+	# book: OrderBook, or an iterable of OrderBooks written one after the other, so a snapshot never has to be in memory
+	# all at once; capacity is then needed, an upper bound on the total number of orders
+	# returns no. of orders written
+	if timestamp is None: timestamp = time.time()
+	if isinstance(book, orderbook.OrderBook): book, capacity = [book], len(book)
+	if capacity is None: raise Exception('Need a capacity to write a snapshot in chunks')
+
+	offset = _align(HEADER.size + COLUMN.size*len(orderbook.COLUMNS))
+	entries, offsets = [], []
+	for name, typecode in orderbook.COLUMNS:
+		itemsize = array(typecode).itemsize
+		entries.append(COLUMN.pack(name.encode(), typecode.encode(), itemsize, offset))
+		offsets.append((name, itemsize, offset))
+		offset = _align(offset + capacity*itemsize)
+
+	datapath = '{}.{:016x}-{}'.format(os.path.abspath(path), time.time_ns(), os.getpid())
+	norders = 0
+	try:
+		with open(datapath, 'wb') as outfile:
+			outfile.write(HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little', len(entries), 0, timestamp))
+			for entry in entries: outfile.write(entry)
+
+			for chunk in book:
+				if norders + len(chunk) > capacity: raise Exception('More orders than the {} the snapshot was sized for'.format(capacity))
+				for name, itemsize, offset in offsets:
+					outfile.seek(offset + norders*itemsize)
+					outfile.write(memoryview(getattr(chunk, name)).cast('B'))
+				norders += len(chunk)
+
+			# the real count goes in last, a chunked book can come up short of its capacity
+			outfile.seek(0)
+			outfile.write(HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little', len(entries), norders, timestamp))
+
+			outfile.flush()
+			os.fsync(outfile.fileno())
+	except BaseException:
+		os.remove(datapath) # never pointed at, nobody can have it open
+		raise
+
+	tmppath = '{}.{}.tmp'.format(path, os.getpid())
+	with open(tmppath, 'w') as outfile:
+		outfile.write(os.path.basename(datapath))
+		outfile.flush()
+		os.fsync(outfile.fileno())
+	_replace(tmppath, path)
+
+	# older versions go once nobody has them mapped any more; on Windows that can take until a later write
+	for old in _versions(path):
+		if old >= datapath: break
+		try:
+			os.remove(old)
+		except OSError:
+			pass
+
+	return norders
+
+def remove(path):
+	# the snapshot and every version of it, as far as they can be removed right now
+	if os.path.isfile(path): os.remove(path)
+
+	for old in _versions(path):
+		try:
+			os.remove(old)
+		except OSError:
+			pass
+
+def read(path):
+	# returns (OrderBook over the mapped file, snapshot timestamp)
+	# the book is read-only and keeps the mapping alive for as long as it's around
+	for attempt in range(REPLACE_RETRIES):
+		try:
+			return _read(_current(path))
+		except FileNotFoundError:
+			# a writer cleaned up the version we were pointed at just before we opened it, the pointer has moved on
+			if attempt == REPLACE_RETRIES - 1: raise
+
+def _read(path):
+	with open(path, 'rb') as infile:
+		size = os.fstat(infile.fileno()).st_size
+		mapped = (mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) if size else b'')
+
+	if size < HEADER.size: raise Exception('{} is not an order snapshot'.format(path))
+
+	magic, version, littleendian, ncolumns, norders, timestamp = HEADER.unpack_from(mapped, 0)
+	if magic != MAGIC: raise Exception('{} is not an order snapshot'.format(path))
+	if version != VERSION: raise Exception('{} is snapshot version {}, expected {}'.format(path, version, VERSION))
+	if bool(littleendian) != (sys.byteorder == 'little'): raise Exception('{} was written on a machine with the other byte order'.format(path))
+
+	view = memoryview(mapped)
+	columns = {}
+	for ii in range(ncolumns):
+		name, typecode, itemsize, offset = COLUMN.unpack_from(mapped, HEADER.size + COLUMN.size*ii)
+		name, typecode = name.rstrip(b'\0').decode(), typecode.rstrip(b'\0').decode()
+		columns[name] = view[offset:offset + norders*itemsize].cast(typecode)
+
+	missing = [name for name, typecode in orderbook.COLUMNS if name not in columns]
+	if missing: raise Exception('{} is missing columns: {}'.format(path, ', '.join(missing)))
+
+	return orderbook.OrderBook.fromcolumns(columns), timestamp
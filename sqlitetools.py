@@ -1,6 +1,67 @@
 ## Functions for doing general operations on sqlite dbs
 
 import sqlite3
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+# applied to every connection opened through connect()
+PRAGMAS = (
+	('journal_mode', 'WAL'), # readers don't block the writer
+	('synchronous', 'NORMAL'), # safe with WAL, only the last commits can be lost on power failure
+	('cache_size', -64*1024), # KiB
+	('mmap_size', 256*1024**2),
+	('temp_store', 'MEMORY'),
+	)
+
+# swapped in for the duration of a bulk load, durability is traded for speed
+BULK_PRAGMAS = (
+	('synchronous', 'OFF'),
+	('journal_mode', 'MEMORY'), # can't leave WAL while other connections are open, then WAL it is
+	)
+
+BULK_CHUNK_SIZE = 50000 # rows per transaction in bulk loads
+
+def connect(db, pragmas=PRAGMAS, **kwargs):
+	# sqlite3.connect with our pragmas, kwargs go to sqlite3.connect
+	conn = sqlite3.connect(db, **kwargs)
+	for name, value in pragmas: conn.execute('''PRAGMA {}={}'''.format(name, value))
+	return conn
+
+def schemaversion(conn):
+	return conn.execute('''PRAGMA user_version''').fetchone()[0]
+
+def migrate(conn, migrations):
+	# bring a DB up to date in place, schema version is kept in PRAGMA user_version
+	# migrations: sequence of steps, step N (counting from 1) takes the DB from version N-1 to N
+	# each step is a tuple of SQL statements or a callable taking the connection, and runs in its own transaction
+	# returns (old version, new version)
+	oldversion = schemaversion(conn)
+	if oldversion > len(migrations): raise Exception('DB schema version {} is newer than this code knows ({})'.format(oldversion, len(migrations)))
+
+	for version, step in enumerate(migrations[oldversion:], start=oldversion+1):
+		conn.execute('''BEGIN''')
+		try:
+			if callable(step):
+				step(conn)
+			else:
+				for statement in step: conn.execute(statement)
+			conn.execute('''PRAGMA user_version={:d}'''.format(version))
+		except:
+			conn.rollback()
+			raise
+		conn.commit()
+
+	return oldversion, len(migrations)
+
+def addcolumns(conn, table, columns):
+	# ALTER TABLE ADD COLUMN for whichever of columns (e.g. 'price REAL') the table doesn't have yet
+	table = cleanstr(table)
+	existing = set(ii[1] for ii in conn.execute('''PRAGMA table_info({})'''.format(table)))
+
+	for column in columns:
+		column = cleanstr(column)
+		if column.split()[0] not in existing: conn.execute('''ALTER TABLE {} ADD COLUMN {}'''.format(table, column))
 
 def cleanstr(*strings):
 	# strip all non-alphanumeric characters from strings
@@ -14,7 +75,7 @@ def cleanstr(*strings):
 def createtable(db, table, columns):
 	table, columns = cleanstr(table), tuple(cleanstr(ii) for ii in columns)
 
-	conn = sqlite3.connect(db)
+	conn = connect(db)
 	c = conn.cursor()
 
 	c.execute('''DROP TABLE IF EXISTS {}'''.format(table))
@@ -29,21 +90,89 @@ def createtable(db, table, columns):
 def sql_placeholder_of_length(length):
 	return '(' + ', '.join('?'*length) + ')'
 
-def insertmany(db, table, entries):
+@contextmanager
+def relaxed(conn, pragmas=BULK_PRAGMAS):
+	# apply pragmas for the duration, then put the old values back
+	old = []
+	for name, value in pragmas:
+		current = conn.execute('''PRAGMA {}'''.format(name)).fetchone()[0]
+		try:
+			conn.execute('''PRAGMA {}={}'''.format(name, value))
+		except sqlite3.OperationalError:
+			continue
+		old.append((name, current))
+
+	try:
+		yield conn
+	finally:
+		for name, value in reversed(old): conn.execute('''PRAGMA {}={}'''.format(name, value))
+
+@contextmanager
+def deferredindexes(conn, table):
+	# drop table's indexes for the duration and build them again afterwards,
+	# one sort at the end is much cheaper than updating every index for every row
 	table = cleanstr(table)
+	indexes = conn.execute('''SELECT name,sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL''', (table,)).fetchall()
+	for name, sql in indexes: conn.execute('''DROP INDEX {}'''.format(name))
+
+	try:
+		yield conn
+	finally:
+		for name, sql in indexes: conn.execute(sql)
+		conn.commit()
+
+def bulkinsert(conn, table, entries, chunksize=BULK_CHUNK_SIZE, conflict=None, progress=None):
+	# insert rows from any iterable, generators included, one transaction per chunksize rows
+	# so only one chunk is ever in memory
+	# conflict: None, 'IGNORE' or 'REPLACE'
+	# progress(rows so far): optional, called after each chunk is committed, anything it raises stops the load there
+	# returns (rows, rows/sec)
+	table = cleanstr(table)
+	if conflict not in (None, 'IGNORE', 'REPLACE'): raise Exception('conflict must be None, "IGNORE" or "REPLACE"')
 
-	conn = sqlite3.connect(db)
-	c = conn.cursor()
+	entries = iter(entries)
+	sql, nrows = None, 0
 
-	c.executemany('''INSERT INTO {} VALUES {}'''.format(table, sql_placeholder_of_length(len(entries[0]))), entries)
+	t1 = time.time()
+	while True:
+		chunk = list(islice(entries, chunksize))
+		if not chunk: break
 
-	conn.commit()
-	conn.close()
+		if sql is None: sql = '''INSERT {}INTO {} VALUES {}'''.format(('OR {} '.format(conflict) if conflict else ''), table, sql_placeholder_of_length(len(chunk[0])))
+
+		conn.execute('''BEGIN''')
+		try:
+			conn.executemany(sql, chunk)
+		except:
+			conn.rollback()
+			raise
+		conn.commit()
+
+		nrows += len(chunk)
+		if progress is not None: progress(nrows)
+
+	elapsed = time.time() - t1
+
+	return nrows, (nrows / elapsed if elapsed > 0 else float('inf'))
+
+def insertmany(db, table, entries, chunksize=BULK_CHUNK_SIZE, conflict=None):
+	# bulk load: relaxed pragmas, indexes built after the load instead of maintained during it
+	# entries can be any iterable, see bulkinsert
+	# returns (rows, rows/sec)
+	conn = connect(db)
+
+	try:
+		with relaxed(conn), deferredindexes(conn, table):
+			result = bulkinsert(conn, table, entries, chunksize, conflict)
+	finally:
+		conn.close()
+
+	return result
 
 def getcol(db, table, colname, flatten=False, unique=False):
 	table, colname = cleanstr(table, colname)
 
-	conn = sqlite3.connect(db)
+	conn = connect(db)
 	c = conn.cursor()
 
 	if unique:
@@ -0,0 +1,46 @@
+import random
+from operator import attrgetter
+
+import pytest
+
+import evetrade
+
+def nestedfill(sellorders, buyorders):
+	# the original nested-loop fill, kept here as the reference
+	sellorders = sorted(sellorders, key=attrgetter('price'), reverse=False)
+	buyorders = sorted(buyorders, key=attrgetter('price'), reverse=True)
+
+	trades = []
+	tracker = {order.orderID: order.orderQty for order in (sellorders + buyorders)}
+
+	for bb in buyorders:
+		for ss in sellorders:
+			if tracker[bb.orderID] <= 0: break
+			if ss.price >= bb.price: break
+			if tracker[ss.orderID] <= 0: continue
+
+			tradeqty = min(tracker[ss.orderID], tracker[bb.orderID])
+			trades.append((ss.orderID, bb.orderID, tradeqty))
+
+			tracker[ss.orderID] -= tradeqty
+			tracker[bb.orderID] -= tradeqty
+
+	return trades
+
+def randombook(rng, ordertype, systemID, n, firstID):
+	# few distinct prices so there are plenty of ties, quantities small enough that most fills are partial
+	return [evetrade.Order(firstID + ii, 34, ordertype, rng.choice([9.0, 9.5, 10.0, 10.5, 11.0]), rng.randrange(1, 30), 60000000, systemID) for ii in range(n)]
+
+@pytest.mark.parametrize('seed', range(200))
+def test_fillorders_matches_nested_loop(seed):
+	rng = random.Random(seed)
+	sellorders = randombook(rng, 'sell', 1, rng.randrange(0, 15), 0)
+	buyorders = randombook(rng, 'buy', 2, rng.randrange(0, 15), 1000)
+
+	expected = nestedfill(sellorders, buyorders)
+	trades = evetrade.fillorders(sellorders, buyorders)
+
+	assert [(ii.sellorder.orderID, ii.buyorder.orderID, ii.tradeqty) for ii in trades] == expected
+
+	presorted = evetrade.fillorders(sorted(sellorders, key=attrgetter('price')), sorted(buyorders, key=attrgetter('price'), reverse=True), presorted=True)
+	assert [(ii.sellorder.orderID, ii.buyorder.orderID, ii.tradeqty) for ii in presorted] == expected
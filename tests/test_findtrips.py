@@ -0,0 +1,38 @@
+import random
+
+import pytest
+
+import evetrade
+
+MAXVOL, MINPROFITPERTRIP, MINPROFITPERTRADE, MINPROFITPERJUMP = 300, 20, 2, 2
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+	monkeypatch.setattr(evetrade, 'getiteminfo', lambda itemID: {'name': str(itemID), 'volume': 0.5 + (itemID % 7) * 1.5})
+	monkeypatch.setattr(evetrade, 'getjumps', lambda waypoints, highseconly: abs(waypoints[0] - waypoints[1]) % 9 + 1)
+
+def randomtrades(seed):
+	rng = random.Random(seed)
+	orders = [evetrade.Order(ii, rng.randrange(12), rng.choice(['buy', 'sell']), round(rng.uniform(5, 15), 2), rng.randrange(1, 60), 60000000, rng.randrange(1, 7)) for ii in range(200)]
+	return evetrade.findtrades(orders)
+
+def score(trip, rankby):
+	return (trip.profit() if rankby == 'profit' else trip.profitperjump(highseconly=False))
+
+@pytest.mark.parametrize('rankby', ['profit', 'profitperjump'])
+@pytest.mark.parametrize('seed', range(100))
+def test_topk_matches_sorted_full_search(seed, rankby):
+	trades = randomtrades(seed)
+	alltrips = evetrade.findtrips(trades, MAXVOL, MINPROFITPERTRIP, MINPROFITPERTRADE, MINPROFITPERJUMP, highseconly=False)
+	full = sorted(((score(tt, rankby), tt.startsystem, tt.endsystem, tt.profit()) for tt in alltrips), reverse=True)
+
+	for topk in (1, 3, 10):
+		best = evetrade.findtrips(trades, MAXVOL, MINPROFITPERTRIP, MINPROFITPERTRADE, MINPROFITPERJUMP, highseconly=False, topk=topk, rankby=rankby)
+
+		# best first, and the same scores the full search has at the top (which of two tied routes gets in can differ)
+		scores = [score(tt, rankby) for tt in best]
+		assert scores == sorted(scores, reverse=True)
+		assert scores == [ii[0] for ii in full[:topk]]
+
+		# and the very same trips
+		for tt in best: assert (score(tt, rankby), tt.startsystem, tt.endsystem, tt.profit()) in full
@@ -0,0 +1,50 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+import packer
+
+def bruteforce(unitvol, unitprofit, maxqty, maxvol, unitcost=None, capital=None):
+	# best profit over every combination of quantities
+	best = 0
+	for qty in itertools.product(*[range(qq + 1) for qq in maxqty]):
+		if np.dot(qty, unitvol) > maxvol + 1e-9: continue
+		if capital is not None and np.dot(qty, unitcost) > capital + 1e-9: continue
+		best = max(best, np.dot(qty, unitprofit))
+	return best
+
+def randominstance(seed, withcapital):
+	rng = random.Random(seed)
+	n = rng.randrange(1, 5)
+	unitvol = [round(rng.choice([rng.uniform(0.01, 1), rng.uniform(1, 20)]), 2) for ii in range(n)]
+	unitprofit = [round(rng.uniform(1, 100), 1) for ii in range(n)]
+	unitcost = [round(rng.uniform(1, 100), 1) for ii in range(n)]
+	maxqty = [rng.randrange(1, 5) for ii in range(n)]
+
+	# pack wants the best profit per m3 first
+	order = sorted(range(n), key=lambda ii: -unitprofit[ii] / unitvol[ii])
+	unitvol, unitprofit, unitcost, maxqty = ([values[ii] for ii in order] for values in (unitvol, unitprofit, unitcost, maxqty))
+
+	return dict(unitvol=unitvol, unitprofit=unitprofit, maxqty=maxqty, maxvol=round(rng.uniform(1, 20), 2),
+				unitcost=(unitcost if withcapital else None), capital=(round(rng.uniform(10, 200), 1) if withcapital else None))
+
+@pytest.mark.parametrize('withcapital', [False, True])
+@pytest.mark.parametrize('seed', range(300))
+def test_pack_close_to_bruteforce(seed, withcapital):
+	instance = randominstance(seed, withcapital)
+	qty = packer.pack(**instance)
+
+	# always feasible
+	assert np.all(qty >= 0) and np.all(qty <= instance['maxqty'])
+	assert np.dot(qty, instance['unitvol']) <= instance['maxvol'] + 1e-9
+	if withcapital: assert np.dot(qty, instance['unitcost']) <= instance['capital'] + 1e-9
+
+	# the grid rounds sizes up, so it can leave a little on the table, but never much
+	assert np.dot(qty, instance['unitprofit']) >= 0.95 * bruteforce(**instance) - 1e-9
+
+def test_pack_small_dense_trade_doesnt_crowd_out_best():
+	# nearest-cell rounding used to pick an infeasible set here, and trimming it threw away the 65.7 trade
+	qty = packer.pack(unitvol=[0.01, 10, 10], unitprofit=[21.8, 65.7, 26.5], maxqty=[1, 1, 1], maxvol=10, unitcost=[52.7, 1.8, 93.3], capital=100)
+	assert qty.tolist() == [0, 1, 0]
@@ -0,0 +1,122 @@
+import os
+import random
+import shutil
+
+import pytest
+
+import evetrade
+import orderbook
+import snapshotfile
+
+def randombook(seed, n=500):
+	rng = random.Random(seed)
+	return orderbook.OrderBook.fromrows((ii, rng.randrange(50), 60000000 + rng.randrange(20), rng.choice(['buy', 'sell']), round(rng.uniform(1, 100), 2), rng.randrange(1, 1000), 30000000 + rng.randrange(20)) for ii in range(n))
+
+def columns(book):
+	return {name: list(getattr(book, name)) for name, typecode in orderbook.COLUMNS}
+
+def chunked(book, size):
+	for start in range(0, len(book), size):
+		chunk = orderbook.OrderBook()
+		for name, typecode in orderbook.COLUMNS: getattr(chunk, name).extend(getattr(book, name)[start:start + size])
+		yield chunk
+
+def versions(path):
+	return [name for name in os.listdir(os.path.dirname(path)) if name.startswith(os.path.basename(path) + '.')]
+
+def test_write_read_roundtrip(tmp_path):
+	path = str(tmp_path / 'orders.snap')
+	book = randombook(1)
+
+	assert snapshotfile.write(path, book, timestamp=123.5) == len(book)
+	mapped, timestamp = snapshotfile.read(path)
+
+	assert timestamp == 123.5
+	assert columns(mapped) == columns(book)
+
+	# path is just a pointer to the one data file
+	assert len(versions(path)) == 1
+	with open(path) as infile: assert infile.read() == versions(path)[0]
+
+def test_chunked_write_matches_whole(tmp_path):
+	path = str(tmp_path / 'orders.snap')
+	book = randombook(2)
+
+	# capacity is only an upper bound, the header ends up with the real count
+	assert snapshotfile.write(path, chunked(book, 64), capacity=len(book) + 37) == len(book)
+	assert columns(snapshotfile.read(path)[0]) == columns(book)
+
+	with pytest.raises(Exception):
+		snapshotfile.write(path, chunked(book, 64), capacity=len(book) - 1)
+
+	# the failed write leaves nothing behind, and the last good snapshot is still current
+	assert len(versions(path)) == 1
+	assert columns(snapshotfile.read(path)[0]) == columns(book)
+
+def test_empty_book(tmp_path):
+	path = str(tmp_path / 'orders.snap')
+	snapshotfile.write(path, orderbook.OrderBook())
+	assert len(snapshotfile.read(path)[0]) == 0
+
+def test_old_versions_cleaned_up(tmp_path):
+	path = str(tmp_path / 'orders.snap')
+	for seed in range(4): snapshotfile.write(path, randombook(seed))
+
+	assert len(versions(path)) == 1
+	assert columns(snapshotfile.read(path)[0]) == columns(randombook(3))
+
+	snapshotfile.remove(path)
+	assert os.listdir(str(tmp_path)) == []
+
+def test_legacy_single_file(tmp_path):
+	# before the pointer file, path was the snapshot itself
+	path = str(tmp_path / 'orders.snap')
+	book = randombook(5)
+	snapshotfile.write(str(tmp_path / 'new.snap'), book)
+	shutil.copy(str(tmp_path / versions(str(tmp_path / 'new.snap'))[0]), path)
+
+	assert columns(snapshotfile.read(path)[0]) == columns(book)
+
+	# and the next write turns it into a pointer
+	snapshotfile.write(path, randombook(6))
+	assert columns(snapshotfile.read(path)[0]) == columns(randombook(6))
+	assert len(versions(path)) == 1
+
+def test_read_while_writing(tmp_path):
+	path = str(tmp_path / 'orders.snap')
+	old, new = randombook(7), randombook(8, n=900)
+	snapshotfile.write(path, old)
+	mapped, timestamp = snapshotfile.read(path)
+
+	def chunks():
+		# halfway through writing the new version, readers still get the whole old one
+		for ii, chunk in enumerate(chunked(new, 100)):
+			if ii == 4: assert columns(snapshotfile.read(path)[0]) == columns(old)
+			yield chunk
+
+	snapshotfile.write(path, chunks(), capacity=len(new))
+
+	assert columns(snapshotfile.read(path)[0]) == columns(new)
+	assert columns(mapped) == columns(old) # a book mapped before the write is left alone
+
+@pytest.fixture
+def orderdir(tmp_path, monkeypatch):
+	# order DB, aux DB and snapshot all in a scratch directory
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr(evetrade, '_auxstore', None)
+	return tmp_path
+
+def test_snapshot_matches_order_db(orderdir):
+	rng = random.Random(9)
+	orders = [evetrade.Order(ii, rng.randrange(30), rng.choice(['buy', 'sell']), round(rng.uniform(1, 100), 2), rng.randrange(1, 100), 60000000 + ii % 9, 30000000 + ii % 9) for ii in range(3000)]
+	evetrade.writeorderstoDB(orders)
+
+	fromdb = evetrade.readordersfromDB()
+	assert columns(evetrade.loadorders()) == columns(fromdb)
+
+	# streamed out of the DB a chunk at a time gives the same file
+	assert evetrade.writesnapshotfile(chunksize=128) == len(fromdb)
+	assert columns(evetrade.loadorders()) == columns(fromdb)
+
+	evetrade.initorderDB()
+	assert not os.path.exists(evetrade.SNAPSHOTFILE) and versions(os.path.abspath(evetrade.SNAPSHOTFILE)) == []
@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+import evetrade
+
+MAXVOL, MINPROFITPERTRIP, MINPROFITPERTRADE, MINPROFITPERJUMP = 500, 50, 5, 5
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+	# no aux DB or dotlan, just made-up volumes and jumps
+	monkeypatch.setattr(evetrade, 'getiteminfo', lambda itemID: {'name': str(itemID), 'volume': 1 + (itemID % 5) * 0.5})
+	monkeypatch.setattr(evetrade, 'getjumps', lambda waypoints, highseconly: abs(waypoints[0] - waypoints[1]) % 7 + 1)
+
+def randomorder(rng, orderID):
+	# few items, systems and prices, so plenty of equal prices competing for the same fills
+	return evetrade.Order(orderID, rng.randrange(6), rng.choice(['buy', 'sell']), rng.choice([10.0, 10.5, 11.0, 11.5, 12.0]), rng.randrange(1, 40), 60000000, rng.randrange(1, 9))
+
+def nextsnapshot(rng, orders, nextID, pricesonly):
+	# same order as before, changed orders in place, removed ones dropped and new ones at the end
+	neworders = []
+	for oo in orders:
+		if not pricesonly and rng.random() < 0.1: continue
+		if rng.random() < 0.2:
+			oo = evetrade.Order(oo.orderID, oo.itemID, oo.orderType, rng.choice([10.0, 10.5, 11.0, 11.5, 12.0]),
+								(oo.orderQty if pricesonly else rng.randrange(1, 40)), oo.locationID, oo.systemID)
+		neworders.append(oo)
+
+	if not pricesonly:
+		for ii in range(rng.randrange(10)): neworders.append(randomorder(rng, nextID + ii))
+
+	return neworders
+
+def tripsbyroute(trips):
+	return {(tt.startsystem, tt.endsystem): (tt.profit(), [(ii.sellorder.orderID, ii.buyorder.orderID, ii.tradeqty) for ii in tt.trades]) for tt in trips}
+
+@pytest.mark.parametrize('pricesonly', [True, False])
+@pytest.mark.parametrize('seed', range(40))
+def test_refresh_matches_full_search(seed, pricesonly):
+	rng = random.Random(seed)
+	orders = [randomorder(rng, ii) for ii in range(300)]
+	finder = evetrade.TradeFinder(orders, MAXVOL, MINPROFITPERTRIP, MINPROFITPERTRADE, MINPROFITPERJUMP, highseconly=False)
+
+	for step in range(5):
+		orders = nextsnapshot(rng, orders, 1000 * (step + 1), pricesonly)
+		finder.refresh(orders)
+
+		expected = evetrade.findtrips(evetrade.findtrades(orders), MAXVOL, MINPROFITPERTRIP, MINPROFITPERTRADE, MINPROFITPERJUMP, highseconly=False)
+		assert tripsbyroute(finder.alltrips()) == tripsbyroute(expected)
+
+def test_trips_leave_shared_trades_alone():
+	# one trade list searched twice, as the web app does from several threads
+	rng = random.Random(0)
+	trades = evetrade.findtrades([randomorder(rng, ii) for ii in range(300)])
+	before = [(tt.tradeqty, tt._trip) for tt in trades]
+
+	first = evetrade.findtrips(trades, MAXVOL, MINPROFITPERTRIP, MINPROFITPERTRADE, MINPROFITPERJUMP, highseconly=False)
+	second = evetrade.findtrips(trades, MAXVOL, MINPROFITPERTRIP, MINPROFITPERTRADE, MINPROFITPERJUMP, highseconly=False)
+	assert first and [(tt.tradeqty, tt._trip) for tt in trades] == before
+
+	# changing a trade in one trip only retotals that trip
+	trip, other = first[0], second[0]
+	profit = other.profit()
+	trip.trades[0].tradeqty = 1
+	assert trip.profit() == round(sum(tt.profit() for tt in trip.trades), 2)
+	assert other.profit() == profit